@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import abc
+import asyncio
+import json
+import logging
+
+from aiodocker.exceptions import DockerError
+
+from .metrics import build_phase_duration, errors_counter
+from .service import (
+    Container,
+    ServiceEntry,
+    Target,
+    container_evict_states,
+    get_container,
+    get_event_container_id,
+    get_event_service_id,
+    get_jobs,
+    get_prometheus_config,
+    get_services_tasks,
+    is_docker_error,
+    is_enabled,
+    limit_call,
+    load_service_entry,
+    timed_call,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Backend(abc.ABC):
+    """
+    Source of the scrape configurations.
+
+    A backend builds the entries of `config.services_entries`, either all
+    at once with `load` or incrementally from docker events with `update`.
+    Caching the entries, diffing and writing the configs is shared by all
+    the backends.
+    """
+    # Container events that can change the scrape configurations
+    config_event_states = []
+    # The backend is only updated by resyncs when it doesn't listen
+    listens_events = True
+
+    def __init__(self, config):
+        self.config = config
+
+    def get_events_filters(self):
+        """Returns the filters of the docker events subscription"""
+        return {
+            "type": ["container"],
+            "event": sorted(
+                set(self.config_event_states + container_evict_states)
+            ),
+        }
+
+    def is_config_event(self, event):
+        """Returns True if the event may change the scrape configurations"""
+        return (
+            event["Type"] == "container" and
+            event["status"] in self.config_event_states
+        )
+
+    @abc.abstractmethod
+    async def load(self):
+        """Rebuild all the entries"""
+
+    async def update(self, events):
+        """
+        Update the entries after a batch of events.
+
+        Returns False when none of the events concerned the entries.
+        """
+        await self.load()
+        return True
+
+
+class SwarmBackend(Backend):
+    """
+    Discover the services of a docker swarm.
+    """
+    config_event_states = ["start", "stop"]
+
+    def get_events_filters(self):
+        filters = super().get_events_filters()
+
+        if self.config.options.swarm_events_only:
+            filters["label"] = ["com.docker.swarm.service.id"]
+
+        return filters
+
+    async def load(self):
+        """
+        Rebuild the entries of all the swarm services.
+
+        The running tasks of the whole swarm are listed in a single call
+        and dispatched to their service instead of listing them per
+        service.
+        """
+        config = self.config
+        docker = config.get_client()
+
+        services, tasks = await asyncio.gather(
+            timed_call(config, 'service_list', docker.services.list),
+            timed_call(
+                config,
+                'task_list',
+                docker.tasks.list,
+                filters={"desired-state": "running"}
+            ),
+        )
+
+        services_tasks = get_services_tasks(tasks)
+
+        services_entries = await asyncio.gather(*[
+            load_service_entry(
+                config, service, services_tasks.get(service["ID"], [])
+            )
+            for service in services
+        ], return_exceptions=True)
+
+        entries = {}
+        for service, entry in zip(services, services_entries):
+            if is_docker_error(entry):
+                # Keep the previous configs of the service if any
+                logger.info("Couldn't load service %s: %s" % (
+                    service["Spec"]["Name"], entry
+                ))
+                errors_counter.inc()
+                entry = config.services_entries.get(service["ID"])
+                if entry is None:
+                    continue
+
+            entries[service["ID"]] = entry
+
+        config.services_entries = entries
+        config.services_loaded = True
+
+    async def update(self, events):
+        if not self.config.options.incremental:
+            return await super().update(events)
+
+        service_ids = set(
+            get_event_service_id(event)
+            for event in events
+        )
+        service_ids.discard(None)
+
+        if not service_ids:
+            logger.debug("Containers aren't part of a service")
+            return False
+
+        await self.update_services(service_ids)
+        return True
+
+    async def update_services(self, service_ids):
+        """
+        Rebuild the entries of the services in `service_ids`.
+        """
+        await asyncio.gather(*[
+            self.update_service(service_id)
+            for service_id in service_ids
+        ])
+
+    async def update_service(self, service_id):
+        """
+        Rebuild the scrape configurations of a single service.
+
+        The new scrape configs replace the ones cached for the service. A
+        service that doesn't exist anymore is removed from the cache.
+        """
+        config = self.config
+        docker = config.get_client()
+
+        try:
+            with build_phase_duration.labels('service_inspect').time():
+                service = await limit_call(
+                    config, docker.services.inspect, service_id
+                )
+        except DockerError as exc:
+            if exc.status != 404:
+                raise
+            service = None
+
+        if service is None:
+            config.services_entries.pop(service_id, None)
+        else:
+            entry = await load_service_entry(config, service)
+            config.services_entries[service_id] = entry
+
+
+class ContainerBackend(Backend):
+    """
+    Discover standalone containers, each container is its own service.
+    """
+    # A stopped container always dies first
+    config_event_states = ["start", "die"]
+
+    def get_events_filters(self):
+        filters = super().get_events_filters()
+
+        if not self.config.enabled_by_default:
+            filters["label"] = ["prometheus.enable=true"]
+
+        return filters
+
+    def load_container(self, container):
+        """
+        Returns the entry of a container, it's its own only target.
+        """
+        config = self.config
+
+        if not is_enabled(config, container.labels):
+            jobs = []
+        else:
+            prom_config = get_prometheus_config(container.labels)
+            target = Target.from_objects(config.options, container=container)
+
+            jobs = get_jobs(prom_config, [target], target.context)
+
+        return ServiceEntry(container.id, container.name, jobs, container.id)
+
+    async def load(self):
+        """
+        Rebuild the entries of all the running containers.
+
+        The labels and addresses of the containers are part of the list so
+        containers don't have to be inspected. The entries of containers
+        that were already running are kept as they can't change.
+        """
+        config = self.config
+        docker = config.get_client()
+
+        filters = {"status": ["running"]}
+        if not config.enabled_by_default:
+            filters["label"] = ["prometheus.enable=true"]
+
+        with build_phase_duration.labels('container_list').time():
+            containers = await limit_call(
+                config, docker.containers.list, filters=json.dumps(filters)
+            )
+
+        entries = {}
+        for container in containers:
+            container_id = container._container["Id"]
+            entry = config.services_entries.get(container_id)
+            if entry is None:
+                entry = self.load_container(Container.from_docker(container))
+            entries[container_id] = entry
+
+        config.services_entries = entries
+        config.services_loaded = True
+
+    async def update(self, events):
+        """
+        Update the entries of the containers of `events`.
+
+        Events are applied in order as a container may start and die in
+        the same batch.
+        """
+        for event in events:
+            await self.update_container(event)
+        return True
+
+    async def update_container(self, event):
+        """
+        Update the scrape configurations of the container of an event.
+
+        Started containers are inspected to build their entry and dead
+        containers are removed from the cache.
+        """
+        config = self.config
+        container_id = get_event_container_id(event)
+
+        if event["status"] != "start":
+            config.services_entries.pop(container_id, None)
+            return
+
+        # Containers labels are part of the event attributes
+        attributes = event.get("Actor", {}).get("Attributes") or {}
+        if not is_enabled(config, attributes):
+            return
+
+        try:
+            container = await get_container(config, container_id)
+        except DockerError as exc:
+            if exc.status != 404:
+                raise
+            # The container is already gone
+            return
+
+        config.services_entries[container_id] = self.load_container(
+            container
+        )
+
+
+class StaticBackend(Backend):
+    """
+    Discover the hosts of the labels defined in `--static-file`.
+    """
+    listens_events = False
+
+    async def load(self):
+        """
+        Rebuild the entries of the static hosts file.
+
+        The file maps names to labels, the jobs of the labels must define
+        their hosts. The entry of a name is kept while its labels are the
+        same.
+        """
+        config = self.config
+
+        with open(config.options.static_file) as fin:
+            static_labels = json.load(fin)
+
+        entries = {}
+        for name, labels in static_labels.items():
+            key = frozenset(labels.items())
+
+            entry = config.services_entries.get(name)
+            if entry is None or entry.key != key:
+                jobs = []
+                if is_enabled(config, labels):
+                    prom_config = get_prometheus_config(labels)
+                    jobs = get_jobs(prom_config, [])
+                entry = ServiceEntry(name, name, jobs, key)
+
+            entries[name] = entry
+
+        config.services_entries = entries
+        config.services_loaded = True
+
+
+backends = {
+    "swarm": SwarmBackend,
+    "container": ContainerBackend,
+    "static": StaticBackend,
+}
+
+
+def get_backend(config):
+    """Returns the backend of the `--mode` of the config"""
+    return backends[config.options.mode](config)
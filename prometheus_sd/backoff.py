@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import asyncio
+import random
+
+
+class CircuitBreaker(object):
+    """
+    Exponential backoff with jitter between attempts.
+
+    Each failure doubles the delay before the next attempt starting at
+    `min_delay` up to `max_delay`. After `threshold` consecutive failures
+    the breaker opens and attempts are only retried every `max_delay`.
+    The attempt following an open state is half open, it closes the
+    breaker on success or opens it again on failure.
+
+    The state is reported in the `gauge` if one is provided.
+    """
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, min_delay=1, max_delay=60, threshold=5, gauge=None):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.gauge = gauge
+        self.failures = 0
+        self.state = None
+        self.set_state(self.CLOSED)
+
+    def set_state(self, state):
+        self.state = state
+        if self.gauge is not None:
+            self.gauge.set(state)
+
+    def success(self):
+        self.failures = 0
+        self.set_state(self.CLOSED)
+
+    def failure(self):
+        self.failures += 1
+
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.set_state(self.OPEN)
+
+    def get_delay(self):
+        """Returns the amount of seconds to wait before the next attempt"""
+        if self.failures == 0:
+            return 0
+
+        if self.state == self.OPEN:
+            return self.max_delay
+
+        exponent = min(self.failures - 1, 32)
+        delay = min(self.max_delay, self.min_delay * 2 ** exponent)
+
+        return random.uniform(delay / 2, delay)
+
+    async def wait(self):
+        """Wait until the next attempt can be made"""
+        delay = self.get_delay()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.state == self.OPEN:
+            self.set_state(self.HALF_OPEN)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the service discovery against a synthetic docker API.
+
+Run them with:
+
+    python -m prometheus_sd.bench --services 400 --tasks 3 --labels 40
+
+Options after `--` are passed to the service discovery itself:
+
+    python -m prometheus_sd.bench --events 500 -- --incremental --debounce 50
+"""
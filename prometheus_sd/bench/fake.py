@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import asyncio
+import collections
+import functools
+import time
+
+from aiodocker.exceptions import DockerError
+
+
+class FakeContainer(object):
+    """Container with the same inspect data as aiodocker containers"""
+    def __init__(self, data):
+        self._container = data
+
+
+class FakeSubscriber(object):
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class FakeEndpoint(object):
+    """Base of the fake API endpoints, counts calls and simulates latency"""
+    name = None
+
+    def __init__(self, docker):
+        self.docker = docker
+
+    async def call(self, method):
+        self.docker.calls["%s.%s" % (self.name, method)] += 1
+        if self.docker.latency:
+            await asyncio.sleep(self.docker.latency)
+
+
+class FakeServices(FakeEndpoint):
+    name = "services"
+
+    async def list(self, filters=None):
+        await self.call("list")
+        return list(self.docker.services_data.values())
+
+    async def inspect(self, service_id):
+        await self.call("inspect")
+        if service_id not in self.docker.services_data:
+            raise DockerError(404, {"message": "service not found"})
+        return self.docker.services_data[service_id]
+
+
+class FakeTasks(FakeEndpoint):
+    name = "tasks"
+
+    async def list(self, filters=None):
+        await self.call("list")
+        filters = filters or {}
+        service = filters.get("service")
+        return [
+            task
+            for task in self.docker.tasks_data.values()
+            if service is None or task["ServiceName"] == service
+        ]
+
+
+class FakeContainers(FakeEndpoint):
+    name = "containers"
+
+    async def get(self, container_id):
+        await self.call("get")
+        if container_id not in self.docker.containers_data:
+            raise DockerError(404, {"message": "container not found"})
+        return FakeContainer(self.docker.containers_data[container_id])
+
+
+class FakeEvents(FakeEndpoint):
+    name = "events"
+
+    def subscribe(self, **params):
+        self.docker.calls["events.subscribe"] += 1
+        subscriber = FakeSubscriber()
+        self.docker.subscribers.append(subscriber)
+        return subscriber
+
+
+class FakeDocker(object):
+    """
+    Synthetic docker swarm with the subset of the aiodocker API used by
+    the service discovery.
+
+    It generates `services` services of `tasks` tasks each. Services,
+    tasks and containers have `labels` labels each. Every API call waits
+    `latency` seconds and is counted in `calls`.
+
+    Use `make_fake_docker` to get a client that can be used as the
+    `docker_client` of a `Config`.
+    """
+    def __init__(self, url=None, services=10, tasks=3, labels=10,
+                 latency=0):
+        self.url = url
+        self.latency = latency
+        self.labels_count = labels
+
+        self.calls = collections.Counter()
+        self.services_data = collections.OrderedDict()
+        self.tasks_data = collections.OrderedDict()
+        self.containers_data = {}
+        self.subscribers = []
+        self.addresses = 0
+        self.tasks_count = 0
+
+        self.services = FakeServices(self)
+        self.tasks = FakeTasks(self)
+        self.containers = FakeContainers(self)
+        self.events = FakeEvents(self)
+
+        for index in range(services):
+            service_id = self.add_service("service_%d" % (index,))
+            for task_index in range(tasks):
+                self.add_task(service_id)
+
+    def get_labels(self, prefix):
+        return {
+            "%s.label_%d" % (prefix, index): "value_%d" % (index,)
+            for index in range(self.labels_count)
+        }
+
+    def get_address(self):
+        self.addresses += 1
+        return "10.%d.%d.%d" % (
+            (self.addresses >> 16) & 255,
+            (self.addresses >> 8) & 255,
+            self.addresses & 255,
+        )
+
+    def add_service(self, name):
+        service_id = "%s_id" % (name,)
+        labels = self.get_labels("bench.service")
+        labels.update({
+            "prometheus.enable": "true",
+            "prometheus.jobs.main.port": "9090",
+            "prometheus.jobs.main.path": "/metrics",
+            "prometheus.jobs.main.labels.service": name,
+        })
+
+        self.services_data[service_id] = {
+            "ID": service_id,
+            "Version": {"Index": 1},
+            "Spec": {"Name": name, "Labels": labels},
+        }
+        return service_id
+
+    def add_task(self, service_id):
+        service = self.services_data[service_id]
+        self.tasks_count += 1
+        task_id = "task_%d" % (self.tasks_count,)
+        container_id = "container_%s" % (task_id,)
+        address = self.get_address()
+
+        self.tasks_data[task_id] = {
+            "ID": task_id,
+            "Version": {"Index": 1},
+            "ServiceID": service_id,
+            "ServiceName": service["Spec"]["Name"],
+            "Labels": self.get_labels("bench.task"),
+            "Status": {
+                "State": "running",
+                "ContainerStatus": {"ContainerID": container_id},
+            },
+            "NetworksAttachments": [
+                {
+                    "Network": {"Spec": {"Name": "overlay"}},
+                    "Addresses": ["%s/16" % (address,)],
+                }
+            ],
+        }
+
+        labels = self.get_labels("bench.container")
+        labels["com.docker.swarm.service.id"] = service_id
+        labels["com.docker.swarm.task.id"] = task_id
+
+        self.containers_data[container_id] = {
+            "Id": container_id,
+            "Config": {"Labels": labels},
+            "NetworkSettings": {
+                "Networks": {"overlay": {"IPAddress": address}}
+            },
+        }
+        return task_id
+
+    def remove_task(self, task_id):
+        task = self.tasks_data.pop(task_id)
+        container_id = task["Status"]["ContainerStatus"]["ContainerID"]
+        self.containers_data.pop(container_id, None)
+        return task
+
+    def make_event(self, status, task):
+        container_id = task["Status"]["ContainerStatus"]["ContainerID"]
+        return {
+            "Type": "container",
+            "status": status,
+            "id": container_id,
+            "timeNano": int(time.time() * 1e9),
+            "Actor": {
+                "ID": container_id,
+                "Attributes": {
+                    "com.docker.swarm.service.id": task["ServiceID"],
+                },
+            },
+        }
+
+    def emit(self, event):
+        """Send an event to every subscriber"""
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait(event)
+
+    def storm(self, count):
+        """
+        Simulate a rolling update replacing `count` tasks, each
+        replacement emits a stop and a start event.
+        """
+        for index in range(count):
+            task_ids = list(self.tasks_data.keys())
+            task = self.remove_task(task_ids[index % len(task_ids)])
+            self.emit(self.make_event("stop", task))
+
+            task_id = self.add_task(task["ServiceID"])
+            self.emit(self.make_event("start", self.tasks_data[task_id]))
+
+    async def close(self):
+        pass
+
+
+def make_fake_docker(**params):
+    """
+    Returns a docker client factory for `Config(docker_client=...)`.
+    """
+    return functools.partial(FakeDocker, **params)
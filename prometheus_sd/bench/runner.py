@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+from ..config import Config, get_parser
+from ..service import (
+    listen_events,
+    load_existing_services,
+    save_configs,
+    serialize_configs,
+)
+from .fake import make_fake_docker
+
+
+class BenchResult(object):
+    """Measures of a single benchmark"""
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0
+        self.calls = {}
+        self.memory_peak = None
+        self.output_size = None
+
+    def format(self):
+        lines = ["%s: %.4fs" % (self.name, self.duration)]
+
+        if self.calls:
+            lines.append("  api calls: %s" % (", ".join(
+                "%s=%d" % (name, count)
+                for name, count in sorted(self.calls.items())
+            ),))
+
+        if self.memory_peak is not None:
+            lines.append("  memory peak: %d bytes" % (self.memory_peak,))
+
+        if self.output_size is not None:
+            lines.append("  output size: %d bytes" % (self.output_size,))
+
+        return "\n".join(lines)
+
+
+class Measure(object):
+    """Context manager measuring the time, calls and memory of a block"""
+    def __init__(self, result, docker, trace_memory=False):
+        self.result = result
+        self.docker = docker
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        self.docker.calls.clear()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self.result
+
+    def __exit__(self, *exc):
+        self.result.duration = time.perf_counter() - self.started
+        self.result.calls = dict(self.docker.calls)
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.result.memory_peak = peak
+
+
+def get_bench_parser():
+    parser = OptionParser(
+        usage="python -m prometheus_sd.bench [options] [-- promsd options]"
+    )
+    parser.add_option("--services", dest="services", type="int", default=100)
+    parser.add_option("--tasks", dest="tasks", type="int", default=3)
+    parser.add_option("--labels", dest="labels", type="int", default=30)
+    parser.add_option(
+        "--latency",
+        dest="latency",
+        type="float",
+        default=0.001,
+        help="Seconds each docker API call takes",
+    )
+    parser.add_option(
+        "--events",
+        dest="events",
+        type="int",
+        default=50,
+        help="Amount of tasks replaced in the event storm",
+    )
+    parser.add_option(
+        "--memory",
+        action="store_true",
+        dest="memory",
+        default=False,
+        help="Trace memory allocations, slows down the benchmarks",
+    )
+    return parser
+
+
+async def run_benchmarks(options, args):
+    """
+    Run the benchmarks and returns their results.
+
+    `args` are the command line arguments of the service discovery, the
+    output goes to a temporary directory unless they define one.
+    """
+    out_dir = tempfile.mkdtemp(prefix="promsd-bench-")
+    results = []
+
+    try:
+        docker_client = make_fake_docker(
+            services=options.services,
+            tasks=options.tasks,
+            labels=options.labels,
+            latency=options.latency,
+        )
+        config = Config(
+            get_parser(),
+            ['--out', os.path.join(out_dir, 'out.json')] + list(args),
+            docker_client=docker_client,
+        )
+        config.loop = asyncio.get_event_loop()
+        docker = config.get_client()
+
+        for name in ["load_existing_services (cold)",
+                     "load_existing_services (warm)"]:
+            result = BenchResult(name)
+            with Measure(result, docker, options.memory):
+                configs = await load_existing_services(config)
+            data, digest = serialize_configs(configs)
+            result.output_size = len(data)
+            results.append(result)
+
+        result = BenchResult("save_configs")
+        with Measure(result, docker, options.memory):
+            await save_configs(config, configs)
+        results.append(result)
+
+        result = BenchResult("listen_events (%d replaced tasks)" % (
+            options.events,
+        ))
+        with Measure(result, docker, options.memory):
+            task = config.loop.create_task(listen_events(config))
+            # Let listen_events subscribe before the storm
+            await asyncio.sleep(0)
+            docker.storm(options.events)
+            # The end of the stream stops listen_events
+            docker.emit(None)
+            try:
+                await task
+            except ConnectionError:
+                pass
+        results.append(result)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return results
+
+
+def main(argv=None):
+    parser = get_bench_parser()
+    options, args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run_benchmarks(options, args))
+
+    print("%d services, %d tasks per service, %d labels, %.4fs latency" % (
+        options.services, options.tasks, options.labels, options.latency
+    ))
+    for result in results:
+        print(result.format())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded dictionary like cache.
+
+    Once `maxsize` keys are stored, the least recently used keys get
+    evicted. A `maxsize` of 0 disables the cache.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            return default
+
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        self.data[key] = value
+        self.data.move_to_end(key)
+
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def values(self):
+        """Returns the values from the least to the most recently used"""
+        return list(self.data.values())
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
@@ -10,7 +10,7 @@ import logging
 
 from .config import Config
 from .config import get_parser, setup_logging
-from .service import main_loop
+from .leader import leader_loop
 from .server import make_server
 
 logger = logging.getLogger(__name__)
@@ -30,10 +30,10 @@ def main(args=None, block=True):
     config.loop = loop
 
     webserver = None
-    if config.options.metrics:
+    if config.options.metrics or config.options.http_sd:
         webserver = loop.create_task(make_server(config))
 
-    task = loop.create_task(main_loop(config))
+    task = loop.create_task(leader_loop(config))
 
     if block:
         loop.run_until_complete(task)
@@ -16,10 +16,15 @@
 #
 ##############################################################################
 import sys
+import asyncio
 import aiodocker
 from optparse import OptionParser
 import logging
 
+from .backends import get_backend
+from .cache import LRUCache
+from .instrument import InstrumentedDocker
+
 logger = logging.getLogger(__name__)
 
 docker_url = "unix:///var/run/docker.sock"
@@ -38,14 +43,46 @@ class Config(object):
         self.inited = False
         self.enabled_by_default = not self.options.only_enabled
 
+        # Source of the scrape configs
+        self.backend = get_backend(self)
+
+        # Scrape configs of each service indexed by service ID
+        self.services_entries = {}
+        self.services_loaded = False
+        # Prevent concurrent builds from overwriting each other
+        self.build_lock = asyncio.Lock()
+
+        # Container inspects indexed by container ID
+        self.containers_cache = LRUCache(self.options.container_cache_size)
+
+        # Digest of the last content written in each output file
+        self.files_digests = {}
+        # Shard files written in the output directory
+        self.shards_paths = None
+
+        # Last configs served by the http service discovery
+        self.http_sd_data = None
+        self.http_sd_etag = None
+
     def validate(self):
-        if not self.options.out:
+        outputs = [self.options.out, self.options.out_dir, self.options.http_sd]
+        if not any(outputs):
+            self.parser.print_help()
+            return False
+        if self.options.mode == "static" and not self.options.static_file:
+            self.parser.print_help()
+            return False
+        if self.options.task_addresses and self.options.container_labels:
+            # Containers aren't inspected when using the task addresses
             self.parser.print_help()
             return False
         return True
 
     def init(self):
-        self.docker = self.docker_client(url=self.options.host)
+        self.docker = InstrumentedDocker(
+            self.docker_client(url=self.options.host)
+        )
+        self.semaphore = asyncio.Semaphore(self.options.max_concurrency)
         self.inited = True
 
     async def deinit(self):
@@ -61,6 +98,28 @@ class Config(object):
 def get_parser():
     parser = OptionParser()
     parser.add_option("-o", "--out", dest="out", help="Output File")
+    parser.add_option(
+        "--out-dir",
+        dest="out_dir",
+        default=None,
+        help="Output directory of the configs sharded by --shard-by",
+    )
+    parser.add_option(
+        "--shard-by",
+        dest="shard_by",
+        type="choice",
+        choices=["job", "service"],
+        default="job",
+        help="Write one file per: job|service",
+    )
+    parser.add_option(
+        "--fsync",
+        dest="fsync",
+        type="choice",
+        choices=["always", "never"],
+        default="always",
+        help="Flush the output to disk before replacing it: always|never",
+    )
     parser.add_option(
         "--host", dest="host", default=docker_url, help="Docker Host/Socket",
     )
@@ -68,6 +127,135 @@ def get_parser():
     parser.add_option("--log-file", dest="log_file", default=None)
     parser.add_option("--only-enabled", dest="only_enabled", default=True)
 
+    parser.add_option(
+        "--mode",
+        dest="mode",
+        type="choice",
+        choices=["swarm", "container", "static"],
+        default="swarm",
+        help="Discover targets from: swarm|container|static",
+    )
+
+    parser.add_option(
+        "--static-file",
+        dest="static_file",
+        default=None,
+        help="JSON file of the labels of each static host in static mode",
+    )
+
+    parser.add_option(
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        default=False,
+        help="Only rebuild the service of a container on events",
+    )
+
+    parser.add_option(
+        "--swarm-events-only",
+        action="store_true",
+        dest="swarm_events_only",
+        default=False,
+        help="Only listen to events of containers started by swarm",
+    )
+
+    parser.add_option(
+        "--debounce",
+        dest="debounce",
+        type="int",
+        default=0,
+        help="Milliseconds to wait for more events before rebuilding",
+    )
+
+    parser.add_option(
+        "--debounce-max",
+        dest="debounce_max",
+        type="int",
+        default=5000,
+        help="Max milliseconds to delay a rebuild while debouncing",
+    )
+
+    parser.add_option(
+        "--resync-interval",
+        dest="resync_interval",
+        type="float",
+        default=0,
+        help="Seconds between periodic full rebuilds, 0 to disable",
+    )
+
+    parser.add_option(
+        "--snapshot",
+        dest="snapshot",
+        default=None,
+        help="File persisting the discovery state to restore on startup",
+    )
+
+    parser.add_option(
+        "--lock-file",
+        dest="lock_file",
+        default=None,
+        help="Only run discovery while holding this lock, others follow",
+    )
+
+    parser.add_option(
+        "--lock-interval",
+        dest="lock_interval",
+        type="float",
+        default=5.0,
+        help="Seconds between attempts of followers to take the lock",
+    )
+
+    parser.add_option(
+        "--max-concurrency",
+        dest="max_concurrency",
+        type="int",
+        default=10,
+        help="Max amount of concurrent calls to the docker API",
+    )
+
+    parser.add_option(
+        "--container-cache-size",
+        dest="container_cache_size",
+        type="int",
+        default=4096,
+        help="Max amount of container inspects kept in memory, 0 to disable",
+    )
+
+    parser.add_option(
+        "--backoff-min",
+        dest="backoff_min",
+        type="float",
+        default=1.0,
+        help="Seconds to wait before restarting after a first failure",
+    )
+
+    parser.add_option(
+        "--backoff-max",
+        dest="backoff_max",
+        type="float",
+        default=60.0,
+        help="Max seconds to wait before restarting after failures",
+    )
+
+    parser.add_option(
+        "--breaker-threshold",
+        dest="breaker_threshold",
+        type="int",
+        default=5,
+        help="Consecutive failures before the circuit breaker opens",
+    )
+
+    parser.add_option(
+        "--task-addresses",
+        action="store_true",
+        dest="task_addresses",
+        default=False,
+        help=(
+            "Get target addresses from tasks instead of containers, "
+            "can't be used with --container-labels"
+        ),
+    )
+
     parser.add_option(
         "--meta-labels",
         action="store_true",
@@ -122,6 +310,20 @@ def get_parser():
         default='localhost'
     )
 
+    parser.add_option(
+        '--http-sd',
+        action="store_true",
+        dest="http_sd",
+        default=False,
+        help="Serve the configs for prometheus http_sd_configs",
+    )
+
+    parser.add_option(
+        '--http-sd.path',
+        dest="http_sd_path",
+        default="/http_sd"
+    )
+
     return parser
 
 
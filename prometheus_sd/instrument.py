@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import asyncio
+import functools
+
+from .metrics import (
+    docker_api_calls,
+    docker_api_duration,
+    docker_api_in_flight,
+)
+
+
+class InstrumentedEndpoint(object):
+    """
+    Proxy of a docker client endpoint (services, tasks...) that counts and
+    times the calls of its coroutine methods.
+
+    Subscriptions to the events stream are only counted, the stream stays
+    open as long as the service discovery listens to events.
+    """
+    counted_methods = ["subscribe"]
+
+    def __init__(self, endpoint, name):
+        self._endpoint = endpoint
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._endpoint, attr)
+        endpoint = "%s.%s" % (self._name, attr)
+
+        if attr in self.counted_methods:
+            @functools.wraps(value)
+            def counter(*args, **kwargs):
+                docker_api_calls.labels(endpoint).inc()
+                return value(*args, **kwargs)
+
+            return counter
+
+        if not asyncio.iscoroutinefunction(value):
+            return value
+
+        @functools.wraps(value)
+        async def wrapper(*args, **kwargs):
+            docker_api_calls.labels(endpoint).inc()
+            with docker_api_in_flight.track_inprogress():
+                with docker_api_duration.labels(endpoint).time():
+                    return await value(*args, **kwargs)
+
+        return wrapper
+
+
+class InstrumentedDocker(object):
+    """
+    Proxy of a docker client instrumenting the endpoints used by the
+    service discovery. Other attributes are the ones of the client.
+    """
+    endpoints = ["services", "tasks", "containers", "events"]
+
+    def __init__(self, docker):
+        self._docker = docker
+
+    def __getattr__(self, attr):
+        value = getattr(self._docker, attr)
+
+        if attr in self.endpoints:
+            value = InstrumentedEndpoint(value, attr)
+            # Next lookups won't go through __getattr__
+            setattr(self, attr, value)
+
+        return value
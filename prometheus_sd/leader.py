@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+import asyncio
+import fcntl
+import json
+import logging
+import os
+
+from aiofile import AIOFile
+
+from .metrics import leader_state
+from .service import (
+    get_cached_configs,
+    main_loop,
+    publish_configs,
+    read_snapshot,
+    serialize_configs,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LockFile(object):
+    """
+    Exclusive lock held on a file with `flock`.
+
+    The lock is released by the kernel when the process holding it dies,
+    so a crashed leader can't keep the followers waiting. The PID of the
+    holder is written in the file for debugging purposes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def acquire(self):
+        """Try to take the lock without blocking, returns True on success"""
+        if self.locked:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        os.ftruncate(fd, 0)
+        os.write(fd, ("%d\n" % (os.getpid(),)).encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if not self.locked:
+            return
+
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+async def load_leader_snapshot(config):
+    """
+    Restore the state written by the leader in `--snapshot`.
+
+    The follower gets the entries and containers cache of the leader, so
+    its first build after an election only rebuilds what changed.
+    """
+    if not await read_snapshot(config):
+        return
+
+    logger.debug("Loaded the leader snapshot %s" % (config.options.snapshot,))
+
+    data, digest = serialize_configs(get_cached_configs(config))
+
+    if config.options.out:
+        config.files_digests[config.options.out] = digest
+
+    if config.options.http_sd:
+        publish_configs(config, data, digest)
+
+
+async def load_leader_output(config):
+    """
+    Load the configs written by the leader in `--snapshot` or `--out`.
+
+    The configs are served by the http service discovery of the follower
+    and their digest is kept so the file isn't rewritten when the
+    follower becomes the leader and builds the same configs.
+    """
+    if config.options.snapshot:
+        await load_leader_snapshot(config)
+        return
+
+    path = config.options.out
+    if not path or not os.path.exists(path):
+        return
+
+    async with AIOFile(path, 'rb') as afp:
+        data = await afp.read()
+
+    try:
+        configs = json.loads(data)
+    except ValueError:
+        logger.info("Invalid configs in %s" % (path,))
+        return
+
+    data, digest = serialize_configs(configs)
+
+    if config.files_digests.get(path) == digest:
+        return
+
+    logger.debug("Loaded the leader configs from %s" % (path,))
+    config.files_digests[path] = digest
+
+    if config.options.http_sd:
+        publish_configs(config, data, digest)
+
+
+async def wait_leadership(config, lock):
+    """
+    Wait until the lock is acquired.
+
+    Every `--lock-interval` seconds, the follower tries to take the lock
+    and otherwise loads the output of the leader to stay warm.
+    """
+    while not lock.acquire():
+        try:
+            await load_leader_output(config)
+        except Exception:
+            logger.info("Couldn't load the leader configs", exc_info=True)
+
+        await asyncio.sleep(config.options.lock_interval)
+
+
+async def leader_loop(config):
+    """
+    Run the main loop once elected leader.
+
+    Without `--lock-file`, the main loop runs right away. Otherwise only
+    the instance holding the lock file runs it, which avoids every
+    instance querying the docker API and writing the same outputs.
+    """
+    if not config.options.lock_file:
+        await main_loop(config)
+        return
+
+    lock = LockFile(config.options.lock_file)
+
+    logger.info("Waiting for the lock %s" % (config.options.lock_file,))
+    leader_state.set(0)
+    await wait_leadership(config, lock)
+
+    logger.info("Elected leader")
+    leader_state.set(1)
+
+    try:
+        await main_loop(config)
+    finally:
+        lock.release()
+        leader_state.set(0)
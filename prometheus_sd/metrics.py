@@ -15,7 +15,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
-from prometheus_client.metrics import Counter, Histogram
+from prometheus_client.metrics import Counter, Gauge, Histogram
 from prometheus_client.registry import CollectorRegistry
 from prometheus_client.process_collector import ProcessCollector
 from prometheus_client.gc_collector import GCCollector
@@ -27,11 +27,28 @@ gc_collector = GCCollector(registry=registry)
 req_counter = Counter('promsd_request_count', 'The amount of requests', registry=registry)
 build_counter = Counter('promsd_build_count', 'The amount of time a config is saved', registry=registry)
 event_counter = Counter('promsd_event_count', 'Amount of events received', registry=registry)
+events_coalesced_counter = Counter('promsd_events_coalesced', 'Amount of events handled in the batch of a previous event', registry=registry)
+events_dropped_counter = Counter('promsd_events_dropped', 'Amount of events that did not require a rebuild', registry=registry)
 reinit_counter = Counter('promsd_reinit_count', 'Amount of time service restarted event loop', registry=registry)
 errors_counter = Counter('promsd_errors_count', 'Amount of errors caught', registry=registry)
+resync_counter = Counter('promsd_resync_count', 'Amount of periodic full rebuilds', registry=registry)
+writes_skipped_counter = Counter('promsd_writes_skipped', 'Amount of unchanged configs not written', registry=registry)
+
+circuit_breaker_state = Gauge('promsd_circuit_breaker_state', 'State of the main loop circuit breaker (0 closed, 1 half open, 2 open)', registry=registry)
+
+event_queue_depth = Gauge('promsd_event_queue_depth', 'Amount of docker events waiting to be handled', registry=registry)
+leader_state = Gauge('promsd_leader', 'Whether the instance holds the --lock-file (1) or follows (0)', registry=registry)
+resync_drift = Gauge('promsd_resync_drift', 'Outdated configs found by the last periodic full rebuild', registry=registry)
 
 build_duration = Histogram('promsd_build_seconds', 'Time spent building config', registry=registry)
 config_file_size = Histogram('promsd_config_size_bytes', 'Bytes written in the configuration', registry=registry)
+build_phase_duration = Histogram('promsd_build_phase_seconds', 'Time spent in each phase of a build', ['phase'], registry=registry)
+
+docker_api_calls = Counter('promsd_docker_api_calls', 'Amount of docker API calls', ['endpoint'], registry=registry)
+docker_api_duration = Histogram('promsd_docker_api_seconds', 'Time spent in docker API calls', ['endpoint'], registry=registry)
+docker_api_in_flight = Gauge('promsd_docker_api_in_flight', 'Amount of docker API calls in progress', registry=registry)
+
+event_latency = Histogram('promsd_event_latency_seconds', 'Time between a docker event and the configs being saved', registry=registry)
 configs_quantity = Histogram('promsd_configs_units', 'Quantity of configs generated', registry=registry)
 
 def get_metrics():
@@ -46,11 +63,24 @@ def get_metrics():
         'req_counter': req_counter,
         'build_counter': build_counter,
         'event_counter': event_counter,
+        'events_coalesced_counter': events_coalesced_counter,
+        'events_dropped_counter': events_dropped_counter,
         'reinit_counter': reinit_counter,
         'errors_counter': errors_counter,
+        'writes_skipped_counter': writes_skipped_counter,
+        'resync_counter': resync_counter,
+        'circuit_breaker_state': circuit_breaker_state,
+        'event_queue_depth': event_queue_depth,
+        'resync_drift': resync_drift,
+        'leader_state': leader_state,
         'build_duration': build_duration,
         'config_file_size': config_file_size,
+        'event_latency': event_latency,
         'configs_quantity': configs_quantity,
+        'build_phase_duration': build_phase_duration,
+        'docker_api_calls': docker_api_calls,
+        'docker_api_duration': docker_api_duration,
+        'docker_api_in_flight': docker_api_in_flight,
     }
 
 metrics = get_metrics()
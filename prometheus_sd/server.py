@@ -33,16 +33,52 @@ async def metrics(request):
     return web.Response(text=output.decode('utf-8'))
 
 
+async def http_sd(request):
+    """
+    HTTP service discovery route
+
+    Serves the last configs saved from memory. The response has a strong
+    ETag so requests with a matching `If-None-Match` header get an empty
+    304 response.
+    """
+    req_counter.inc()
+    config = request.app['config']
+
+    if config.http_sd_data is None:
+        # Prometheus keeps its current targets until configs are built
+        return web.Response(status=503)
+
+    headers = {'ETag': config.http_sd_etag}
+
+    if_none_match = request.headers.get('If-None-Match', '')
+    etags = [etag.strip() for etag in if_none_match.split(',')]
+
+    if config.http_sd_etag in etags or '*' in etags:
+        return web.Response(status=304, headers=headers)
+
+    return web.Response(
+        body=config.http_sd_data,
+        content_type='application/json',
+        headers=headers
+    )
+
+
 def make_app(config):
     """
-    Create a small endpoint for metrics
+    Create a small endpoint for metrics and http service discovery
     """
     app = web.Application()
+    app['config'] = config
 
     app.add_routes([
         web.get(config.options.metrics_path, metrics)
     ])
 
+    if config.options.http_sd:
+        app.add_routes([
+            web.get(config.options.http_sd_path, http_sd)
+        ])
+
     return app
 
 
@@ -69,4 +105,12 @@ async def make_server(config):
         config.options.metrics_port,
         config.options.metrics_path
     ))
+
+    if config.options.http_sd:
+        logger.info("HTTP SD endpoint started on http://%s:%s%s" % (
+            config.options.metrics_host,
+            config.options.metrics_port,
+            config.options.http_sd_path
+        ))
+
     await site.start()
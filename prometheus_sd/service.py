@@ -1,75 +1,330 @@
 import asyncio
+import collections
 import aiodocker
+from aiodocker.exceptions import DockerError
 from aiofile import AIOFile
+import os
 import re
 import sys
+import tempfile
+import time
 import json
+import hashlib
 import logging
 
 from .utils import (
-    convert_labels_to_config,
-    extract_prometheus_labels,
     label_template,
+    parse_prometheus_config,
+    sanitize_filename,
     sanitize_label,
     format_label
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .backoff import CircuitBreaker
+from .cache import LRUCache
+
 from .metrics import (
     build_counter,
+    build_phase_duration,
+    circuit_breaker_state,
     event_counter,
     build_duration,
     reinit_counter,
+    resync_counter,
+    resync_drift,
     errors_counter,
     config_file_size,
     configs_quantity,
+    event_latency,
+    event_queue_depth,
+    events_coalesced_counter,
+    events_dropped_counter,
+    writes_skipped_counter,
 )
 
 logger = logging.getLogger(__name__)
 
+# Container events after which a container inspect is outdated
+container_evict_states = ["die", "destroy", "stop"]
+
+
+# Meta labels of containers, tasks and services indexed by object and
+# version. Cached labels are shared and must not be modified.
+meta_labels_cache = LRUCache(8192)
+
+
+def get_version(obj):
+    """Returns the version of a swarm object, it changes on each update"""
+    return obj.get("Version", {}).get("Index")
+
+
+# Label sets shared by the targets and scrape configs, identical label
+# sets of replicas are stored once and so are the label names.
+label_sets_cache = LRUCache(16384)
+label_names_cache = LRUCache(4096)
+
+
+def split_labels(labels):
+    """
+    Returns the (names, values) tuples of the `labels` dict, the names
+    are shared.
+    """
+    names = tuple(sorted(labels))
+    values = tuple(labels[name] for name in names)
+
+    shared_names = label_names_cache.get(names)
+    if shared_names is None:
+        label_names_cache.set(names, names)
+        shared_names = names
+
+    return (shared_names, values)
+
+
+def intern_labels(labels):
+    """
+    Returns the shared (names, values) tuples of the `labels` dict.
+    """
+    labels = split_labels(labels)
+
+    interned = label_sets_cache.get(labels)
+    if interned is None:
+        label_sets_cache.set(labels, labels)
+        interned = labels
+
+    return interned
+
+
+def format_labels(label_type, labels):
+    return {
+        format_label(label_type, key): value
+        for key, value in labels.items()
+    }
+
+
+def get_container_meta_labels(container):
+    if not container:
+        return {}
+
+    # Labels of a container can't change during its lifetime
+    key = ('container', container.id)
+    labels = meta_labels_cache.get(key)
+
+    if labels is None:
+        labels = format_labels('container', container.labels)
+        meta_labels_cache.set(key, labels)
+
+    return labels
+
+
+def get_task_meta_labels(task):
+    if not task:
+        return {}
+
+    key = ('task', task['ID'], get_version(task))
+    labels = meta_labels_cache.get(key)
+
+    if labels is None:
+        labels = format_labels('task', task['Labels'])
+        labels["%s_task_name"] = task['ID']
+        meta_labels_cache.set(key, labels)
+
+    return labels
+
+
+def get_service_meta_labels(service):
+    if not service:
+        return {}
+
+    key = ('service', service['ID'], get_version(service))
+    labels = meta_labels_cache.get(key)
+
+    if labels is None:
+        labels = format_labels('service', service["Spec"]["Labels"])
+        meta_labels_cache.set(key, labels)
+
+    return labels
+
+
+def get_context(options, service=None, task=None, container=None):
+    """
+    Returns the meta labels of the objects enabled in `options`.
+    """
+    context = {}
+
+    if options.use_meta_labels:
+        if options.service_labels:
+            context.update(get_service_meta_labels(service))
+        if options.task_labels:
+            context.update(get_task_meta_labels(task))
+        if options.container_labels:
+            context.update(get_container_meta_labels(container))
+
+    return split_labels(context)
+
+
+def get_networks(task=None, container=None):
+    """
+    Returns the IP address of the target indexed by network name.
+
+    Addresses come from the container inspect when available or else
+    from the network attachments of the task.
+    """
+    if container:
+        return container.networks
+
+    if task:
+        return tuple(
+            (
+                attachment["Network"]["Spec"]["Name"],
+                attachment["Addresses"][0].split("/")[0]
+            )
+            for attachment in task.get("NetworksAttachments") or []
+            if attachment.get("Addresses")
+        )
+
+    return ()
 
-class Target(object):
-    def __init__(self):
-        self.service = None
-        self.task = None
-        self.container = None
 
-    def format_labels(self, label_type, labels):
+class Container(collections.namedtuple(
+    "Container", ["id", "name", "labels", "networks"]
+)):
+    """
+    Fields of a docker container needed by the discovery.
+
+    The network settings and labels of a container can't change during
+    its lifetime, only these are kept instead of the whole inspect.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_docker(cls, container):
+        """Returns the fields of a container listed or inspected"""
+        networks = container._container["NetworkSettings"]["Networks"]
+
+        return cls(
+            container._container["Id"],
+            get_container_name(container),
+            get_container_labels(container),
+            tuple(
+                (name, network["IPAddress"])
+                for name, network in networks.items()
+            )
+        )
+
+
+class Target(collections.namedtuple("Target", ["networks", "context"])):
+    """
+    Addresses of a discovered object and its meta labels.
+
+    `networks` is a tuple of (network name, IP address) and `context` the
+    meta labels, see `get_context`. Targets hold no
+    reference to the docker objects they were built from.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_objects(cls, options, service=None, task=None, container=None):
+        return cls(
+            get_networks(task, container),
+            get_context(options, service, task, container)
+        )
+
+
+class ScrapeConfig(collections.namedtuple(
+    "ScrapeConfig", ["job", "targets", "labels"]
+)):
+    """
+    Target group of a job.
+
+    `targets` is a tuple of hosts and `labels` the interned labels of the
+    group, see `intern_labels`.
+    """
+    __slots__ = ()
+
+    def as_dict(self):
+        """Returns the target group in the file_sd format"""
         return {
-            format_label(label_type, key): value
-            for key, value in labels.items()
+            "labels": dict(zip(*self.labels)),
+            "targets": list(self.targets),
         }
 
-    def get_container_labels(self):
-        if not self.container:
-            return {}
 
-        labels = self.container._container['Config'].get('Labels', {})
-        return self.format_labels('container', labels)
+class ServiceEntry(object):
+    """
+    Scrape configs generated for a single service.
 
-    def get_task_labels(self):
-        if not self.task:
-            return {}
+    Entries are kept in `config.services_entries` indexed by service ID so
+    a single service can be rebuilt without scanning the whole swarm.
 
-        labels = self.task['Labels']
-        labels = self.format_labels('task', labels)
-        labels["%s_task_name"] = self.task['ID']
+    The `key` identifies the state of the service and its tasks the jobs
+    were built from, see `get_service_key`.
+
+    In container mode, entries are built for containers instead and
+    indexed by container ID.
+    """
+    __slots__ = ("service_id", "name", "jobs", "key")
+
+    def __init__(self, service_id, name, jobs, key=None):
+        self.service_id = service_id
+        self.name = name
+        self.jobs = jobs
+        self.key = key
 
-        return labels
 
-    def get_service_labels(self):
-        if not self.service:
-            return {}
+def get_service_key(service, tasks):
+    """
+    Returns a key identifying the state of a service and its tasks.
 
-        labels = self.service["Spec"]["Labels"]
-        return self.format_labels('service', labels)
+    The version of a service changes whenever its spec is updated and the
+    version of a task whenever its status changes. As long as the key is
+    the same, the scrape configs of the service can't change.
+    """
+    return (
+        service["ID"],
+        get_version(service),
+        frozenset(
+            (task["ID"], get_version(task))
+            for task in tasks
+        )
+    )
+
+
+def get_container_labels(container):
+    """
+    Returns the labels of a container listed or inspected.
+    """
+    data = container._container
+    if "Config" in data:
+        return data["Config"].get("Labels") or {}
+    return data.get("Labels") or {}
+
+
+def get_container_name(container):
+    """
+    Returns the name of a container listed or inspected.
+    """
+    data = container._container
+    if "Name" in data:
+        return data["Name"].lstrip("/")
+    names = data.get("Names") or [data["Id"]]
+    return names[0].lstrip("/")
+
+
+def get_event_container_id(event):
+    """Returns the ID of the container of an event"""
+    return event.get("Actor", {}).get("ID") or event.get("id")
+
+
+def get_event_service_id(event):
+    """Returns the ID of the swarm service a container event belongs to"""
+    attributes = event.get("Actor", {}).get("Attributes") or {}
+    return attributes.get("com.docker.swarm.service.id")
 
-    def clone(self):
-        target = Target()
-        target.container = self.container
-        target.task = self.task
-        target.service = self.service
-        return target
-            
 
 def filter_tasks(tasks):
     """Filter tasks that seems impossible to parse further"""
@@ -100,159 +355,244 @@ def relabel_prometheus(job_config):
     return labels
 
 
-async def get_containers_as_target(config, tasks):
-    docker = config.get_client()
-    targets = []
-
-    for task in tasks:
-        container_id = task["Status"]["ContainerStatus"]["ContainerID"]
-        container = await docker.containers.get(container_id)
-
-        target = Target()
-        target.container = container
-        target.task = task
+async def limit_call(config, method, *args, **kwargs):
+    """
+    Call a docker API method while limiting the amount of concurrent calls
+    to `--max-concurrency`.
+    """
+    async with config.semaphore:
+        return await method(*args, **kwargs)
 
-        targets.append(target)
 
-    return targets
+async def timed_call(config, phase, method, *args, **kwargs):
+    """
+    Call a docker API method like `limit_call` while observing its
+    duration in the build phase histogram, so concurrent calls are timed
+    separately.
+    """
+    with build_phase_duration.labels(phase).time():
+        return await limit_call(config, method, *args, **kwargs)
 
 
-def get_hosts(prom_config, service):
-    hosts = prom_config.get('hosts', '')
+def is_docker_error(result):
+    """
+    Returns True if the result of a gathered call is a docker error.
 
-    if hosts:
-        target = Target()
-        target.service = service
-        target.hosts = [
-            host.strip()
-            for host in hosts.split(',')
-            if host.strip()
-        ]
-        return [target]
-    else:
-        return []
+    Docker errors only affect a single object, like a container that died
+    while the config was getting built. Other exceptions are raised.
+    """
+    if isinstance(result, DockerError):
+        return True
+    if isinstance(result, BaseException):
+        raise result
+    return False
 
 
-def get_targets(prom_config, target_objects):
+async def get_container(config, container_id):
     """
-    Get targets for the scrape config, in theory this should be
-    part of the get_target_objects so get_targets return a complete
-    list itself.
+    Inspect a container or get it from the containers cache.
 
-    TODO make it generic so targets can use one method with proper
-    parameters to build a target object.
+    The network settings and labels of a container can't change during
+    its lifetime so the `Container` is cached until the container stops.
+    """
+    container = config.containers_cache.get(container_id)
 
-    One example would be to define target.get_context()
+    if container is None:
+        docker = config.get_client()
+        container = await limit_call(
+            config, docker.containers.get, container_id
+        )
+        container = Container.from_docker(container)
+        config.containers_cache.set(container_id, container)
 
-    This methods return a correct context that can be used by the 
-    service discovery method:
+    return container
 
-    scrape_config = internal.parse_config(config, target.get_context())
 
-    Instead of hard coding container._container["NetworkSettings"]["Networks"]
+def evict_container(config, event):
+    """Remove the container of a die/destroy/stop event from the cache"""
+    if event["Type"] != "container":
+        return
 
-    It could be rewritten as basic rules such as:
+    if event["status"] not in container_evict_states:
+        return
 
-        Expand(@container.NetworkSettings.Networks.*.IPAddress)
+    config.containers_cache.pop(get_event_container_id(event))
 
-    This way each backend can define a set of rules specific to their
-    backend but would all call
 
-    Obviously this method could be called at different level, for example
-    a prom_config can result in multiple targets being found for one object
+async def get_containers_as_target(config, tasks):
+    """
+    Returns the tasks and their inspected container, and whether all the
+    containers could be inspected.
+    """
+    targets = []
+    complete = True
+
+    tasks = list(tasks)
+    with build_phase_duration.labels('container_inspect').time():
+        containers = await asyncio.gather(*[
+            get_container(
+                config, task["Status"]["ContainerStatus"]["ContainerID"]
+            )
+            for task in tasks
+        ], return_exceptions=True)
+
+    for task, container in zip(tasks, containers):
+        if is_docker_error(container):
+            logger.info("Ignoring container of task %s: %s" % (
+                task["ID"], container
+            ))
+            complete = False
+            continue
 
-    while at a later point we could have a similar method to parse the configs
-    for the actual individual final targets.
+        targets.append((task, container))
 
-    Get Targets: Returns a list of target
+    return targets, complete
 
-        config = target.get_default_configs()
-        config.update(prom_config)
-        return internal.get_targets(config, target.get_context())
 
-    Get Configs: Returns a configuration
+def get_tasks_as_target(tasks):
+    """
+    Returns the running tasks without containers.
 
-        config = target.get_default_configs()
-        config.update(prom_config)
-        return internal.parse_configs(config, target.get_context())
+    The addresses of the tasks are found in their network attachments
+    so containers don't have to be inspected. Unlike inspects, it works
+    for containers running on any node of the swarm.
     """
     targets = []
 
-    networks_name = False
-    if prom_config.get('networks'):
-        networks_name = prom_config.get('networks').split(',')
+    for task in tasks:
+        if task["Status"].get("State") != "running":
+            continue
 
-    port = prom_config.get('port', '80')
+        targets.append((task, None))
 
-    def format_host(ip_address):
-        return "%s:%s" % (ip_address, port)    
+    return targets
 
-    for target in target_objects:
-        container = target.container
-        networks = container._container["NetworkSettings"]["Networks"]
 
-        if not networks_name:
-            networks_name = networks.keys()
+def get_hosts(prom_config):
+    """Returns the hosts defined in the job config"""
+    hosts = prom_config.get('hosts', '')
+
+    return tuple(
+        host.strip()
+        for host in hosts.split(',')
+        if host.strip()
+    )
 
-        for network in networks_name:
-            if network not in networks:
+
+def get_targets(prom_config, targets):
+    """
+    Returns the hosts and context of each network address of the targets.
+    """
+    hosts = []
+
+    networks_name = None
+    if prom_config.get('networks'):
+        networks_name = set(prom_config.get('networks').split(','))
+
+    port = prom_config.get('port', '80')
+
+    for target in targets:
+        for network, address in target.networks:
+            if networks_name is not None and network not in networks_name:
                 continue
 
-            address = networks[network]["IPAddress"]
+            hosts.append(("%s:%s" % (address, port), target.context))
 
-            new_target = target.clone()
-            new_target.hosts = [format_host(address)]
+    return hosts
 
-            targets.append(new_target)
 
-    return targets
+def get_services_tasks(tasks):
+    """Returns the tasks indexed by service ID"""
+    services_tasks = {}
 
-async def get_target_objects(config, service):
-    """
-    Docker Swarm Candidate for get_targets().
+    for task in tasks:
+        services_tasks.setdefault(task["ServiceID"], []).append(task)
 
-    But not really it's an internal method that returns containers
-    """
+    return services_tasks
+
+
+async def list_service_tasks(config, service):
+    """Returns the running tasks of a service"""
     docker = config.get_client()
     filters = {
         "desired-state": "running",
         "service": service["Spec"]["Name"],
     }
-    tasks = await docker.tasks.list(filters=filters)
-    targets = await get_containers_as_target(config, filter_tasks(tasks))
-    for target in targets:
-        target.service = service
-    return targets
+    with build_phase_duration.labels('task_list').time():
+        return await limit_call(config, docker.tasks.list, filters=filters)
 
 
-async def load_service_configs(config, service):
+async def get_target_objects(config, service, tasks=None):
     """
-    Load service configs
+    Docker Swarm Candidate for get_targets().
 
-    A service config has the following format:
+    But not really it's an internal method that returns containers
+
+    The running tasks of the service are fetched unless they're passed
+    in `tasks`. Also returns False when some targets are missing because
+    their container couldn't be inspected.
+    """
+    if tasks is None:
+        tasks = await list_service_tasks(config, service)
+
+    if config.options.task_addresses:
+        objects = get_tasks_as_target(filter_tasks(tasks))
+        complete = True
+    else:
+        objects, complete = await get_containers_as_target(
+            config, filter_tasks(tasks)
+        )
+
+    targets = [
+        Target.from_objects(config.options, service, task, container)
+        for task, container in objects
+    ]
+    return targets, complete
+
+
+def is_enabled(config, labels):
+    """
+    Returns True if the object of the labels must be discovered.
+    """
+    enabled_label = labels.get("prometheus.enable")
+
+    # skip if disabled when enabled by default or
+    # skip when not enabled by default and not enabled
+    if (
+        (config.enabled_by_default and enabled_label == 'false') or
+        (not config.enabled_by_default and not enabled_label == 'true') or
+        enabled_label not in ['true', 'false', None]
+    ):
+        return False
+
+    return True
 
-    TODO:
 
-    Change this method so service is a ServiceObject that has multiple targets.
+def get_prometheus_config(labels):
+    """
+    Returns the prometheus config defined in labels.
 
-    Each targets has a context built from the service and the target itself.
+    The config is shared between builds and must not be modified.
+    """
+    with build_phase_duration.labels('label_parse').time():
+        prom_config = parse_prometheus_config(labels)
 
-    For example a target has get_context() which is target.context + target.service.context
-    combined. The context could expose something like this:
+    return prom_config.get('prometheus') or {}
 
-    Swarm Mode:
 
-    - @container: The container
-    - @task: The task of the container
-    - @service: The service of the container
+async def load_service_configs(config, service, tasks=None):
+    """
+    Load service configs, see `build_service_configs`.
+    """
+    jobs, complete = await build_service_configs(config, service, tasks)
+    return jobs
 
-    Container Mode:
 
-    - @container: The container
+async def build_service_configs(config, service, tasks=None):
+    """
+    Load service configs and whether all the targets were found.
 
-    Each possible backend would have context specifics to their backend but the way to
-    generate the context and access their properties would be standardized so only a few
-    methods would be necessary to implement in a simple interface.
+    A service config has the following format:
 
     ====================================  =======================================================
                   Label                         Value
@@ -268,33 +608,29 @@ async def load_service_configs(config, service):
     ====================================  =======================================================
     """
 
-    docker = config.get_client()
-
     service_labels = service["Spec"]["Labels"]
 
-    enabled_label = service_labels.get("prometheus.enable")
+    if not is_enabled(config, service_labels):
+        return [], True
 
-    # Convert service labels to dict
-    prom_labels = extract_prometheus_labels(service_labels)
-    prom_config = convert_labels_to_config(extract_prometheus_labels(service_labels))
-    prom_config = prom_config.get('prometheus')
+    prom_config = get_prometheus_config(service_labels)
 
-    # skip if disabled when enabled by default or
-    # skip when not enabled by default and not enabled
-    if (
-        (config.enabled_by_default and enabled_label == 'false') or
-        (not config.enabled_by_default and not enabled_label == 'true') or
-        enabled_label not in ['true', 'false', None]
-    ):
-        return []
+    target_objects, complete = await get_target_objects(
+        config, service, tasks
+    )
+
+    context = get_context(config.options, service)
 
-    # TODO create tasks to load containers and gather 
-    # valid results and ignore failed ones. It's possible that some
-    # container can die quickly and won't be available during the 
-    # second call it will prevent the service discovery from crashing
-    # and having one container prevent the whole config to get built
+    return get_jobs(prom_config, target_objects, context), complete
+
+
+def get_jobs(prom_config, targets, context=None):
+    """
+    Returns the scrape configs of each job of a prometheus config.
 
-    target_objects = await get_target_objects(config, service)
+    The hosts of the jobs are the addresses of the `targets` unless the
+    job defines its hosts, which get the meta labels of `context`.
+    """
     # In practice each service can declare multiple scrape jobs 
     # by default it will uses the ip of the containers linked to
     # the service or use the host being defined on the job config
@@ -305,131 +641,709 @@ async def load_service_configs(config, service):
     # of manually editing files.
     jobs = []
 
-    # Refactor to this:
-
-    # Ideally the code should be strictly this:
-    # 
-    # jobs = []
-    # 
-    # for config in prom_config.get('jobs'):
-    #     for target in service.get_targets(config):
-    #         jobs.append(target.get_config())
-    # 
-    # return jobs
-         
+    if context is None:
+        context = split_labels({})
 
     for job, job_config in prom_config.get('jobs', {}).items():
-        scrape_config = {
-            "labels": {
-                "job": job
-            }
-        }
+        job_labels = {"job": job}
 
         # Get remapped labels like __scheme__ and __metrics_path__
         # could potentially handle params like __param_
-        scrape_config.get('labels').update(relabel_prometheus(job_config))
+        job_labels.update(relabel_prometheus(job_config))
         # Get all labels and apply to job labels
-        job_labels = {
-            sanitize_label(key): value
+        job_labels.update(
+            (sanitize_label(key), value)
             for key, value in job_config.get('labels', {}).items()
-        }
-        scrape_config.get('labels').update(job_labels)
-
-        # TODO should be one method the if check should be part of the target
-        # found. Remove the abstraction service/container/host|ips and only have
-        # service / targets as the service could be a service or a container
-        targets = (
-            get_targets(job_config, target_objects)
-            if not job_config.get('hosts')
-            else get_hosts(job_config, service)
         )
 
-        # In the meantime pack all hosts together
-        # scrape_config['targets'] = targets
-        # jobs.append(scrape_config)
-        #  TODO get container/service specific labels
-        # TODO replace this code by target.get_config()
-        for target in targets:
-            new_scrape = scrape_config.copy()
-            new_scrape['labels'] = scrape_config['labels'].copy()
-            new_scrape['targets'] = target.hosts
-
-            # Load meta labels from container,task,service 
-            if config.options.use_meta_labels:
-                if config.options.service_labels:
-                    new_scrape['labels'].update(target.get_service_labels())
-                if config.options.task_labels:
-                    new_scrape['labels'].update(target.get_task_labels())
-                if config.options.container_labels:
-                    new_scrape['labels'].update(target.get_container_labels())
-
-            jobs.append(new_scrape)
+        if job_config.get('hosts'):
+            hosts = [(get_hosts(job_config), context)]
+        else:
+            hosts = [
+                ((host,), target_context)
+                for host, target_context in get_targets(job_config, targets)
+            ]
+
+        # Replicas share the same context, only merge it once
+        labels_sets = {}
+
+        for targets_hosts, target_context in hosts:
+            labels = labels_sets.get(target_context)
+
+            if labels is None:
+                # Meta labels from container,task,service
+                labels = dict(job_labels)
+                labels.update(zip(*target_context))
+                labels = intern_labels(labels)
+                labels_sets[target_context] = labels
+
+            jobs.append(ScrapeConfig(job, targets_hosts, labels))
 
     return jobs
 
 
-# TODO in swarm mode, service are services
-# TODO in container mode, containers are services and returns
-# themselves as containers
+async def load_service_entry(config, service, tasks=None):
+    """
+    Returns the entry of a service.
+
+    The cached entry of the service is reused when neither the service
+    nor its running tasks changed since it was built. An entry missing
+    targets whose container couldn't be inspected has no key so it's
+    rebuilt the next time.
+    """
+    if tasks is None:
+        tasks = await list_service_tasks(config, service)
+
+    key = get_service_key(service, tasks)
+
+    entry = config.services_entries.get(service["ID"])
+    if entry is not None and entry.key == key:
+        return entry
+
+    jobs, complete = await build_service_configs(config, service, tasks)
+    if not complete:
+        key = None
+
+    return ServiceEntry(service["ID"], service["Spec"]["Name"], jobs, key)
+
+
 async def load_existing_services(config):
     """
-    Rebuild all the services scrape configurations.
+    Rebuild all the scrape configurations with the backend of the config
+    and returns them.
     """
-    docker = config.get_client()
+    await config.backend.load()
 
-    # TODO make this part async by creating tasks for each service
-    # instead and gather results instead of turning this into sync
-    # code
-    configs = [
-        job_config
-        for service in await docker.services.list()
-        for job_config in await load_service_configs(config, service)
-    ]
+    configs = get_cached_configs(config)
 
     configs_quantity.observe(len(configs))
 
     return configs
 
 
+async def load_events_update(config, events):
+    """
+    Update the scrape configurations after a batch of events and returns
+    them, or None if none of the events concerned the configurations.
+    """
+    if not await config.backend.update(events):
+        return None
+
+    configs = get_cached_configs(config)
+
+    configs_quantity.observe(len(configs))
+
+    return configs
+
+
+def get_cached_configs(config):
+    """
+    Returns the scrape configurations of all the cached services.
+    """
+    return [
+        job_config.as_dict()
+        for entry in config.services_entries.values()
+        for job_config in entry.jobs
+    ]
+
+
 async def save_configs(config, sd_configs):
     """
     Save a configuration based on fetched configs from docker
+
+    The configs are written in the `--out` file and/or sharded in the
+    `--out-dir` directory. With `--http-sd`, they are also kept in memory
+    to be served by the web server.
+    """
+    logger.debug(sd_configs)
+
+    if config.options.http_sd:
+        # The configs are served from memory, write the same data
+        data, digest = serialize_configs(sd_configs)
+        publish_configs(config, data, digest)
+
+        if config.options.out:
+            await save_config_file(config, config.options.out, [data])
+    elif config.options.out:
+        await save_config_file(
+            config, config.options.out, iter_configs_chunks(sd_configs)
+        )
+
+    if config.options.out_dir:
+        await save_shards(config, sd_configs)
+
+    if config.options.snapshot:
+        await save_snapshot(config)
+
+
+def get_shards(config, sd_configs):
+    """
+    Group the configs by output file name according to `--shard-by`.
+
+    Shards by service are built from the cached services entries as the
+    configs themselves don't reference their service.
+    """
+    shards = {}
+
+    if config.options.shard_by == "service":
+        groups = (
+            (entry.name, [job_config.as_dict() for job_config in entry.jobs])
+            for entry in config.services_entries.values()
+        )
+    else:
+        groups = (
+            (job_config["labels"]["job"], [job_config])
+            for job_config in sd_configs
+        )
+
+    for name, configs in groups:
+        if not configs:
+            continue
+        filename = "%s.json" % (sanitize_filename(name),)
+        shards.setdefault(filename, []).extend(configs)
+
+    return shards
+
+
+# File of the output directory listing the shards written by the service
+shards_manifest = ".promsd-shards"
+
+
+def read_shards_manifest(out_dir):
+    """
+    Returns the paths of the shards written by a previous run.
+    """
+    path = os.path.join(out_dir, shards_manifest)
+
+    try:
+        with open(path) as fin:
+            filenames = fin.read().split()
+    except FileNotFoundError:
+        return set()
+
+    return set(
+        os.path.join(out_dir, filename)
+        for filename in filenames
+    )
+
+
+async def save_shards(config, sd_configs):
+    """
+    Save the configs sharded in one file per job or service.
+
+    Only the shards that changed are written and the files of vanished
+    shards are removed. The shards written are listed in a manifest of
+    the output directory, so shards left by a previous run are removed
+    too while files written by anything else are kept.
+    """
+    out_dir = config.options.out_dir
+    shards = get_shards(config, sd_configs)
+
+    # Never overwrite or remove the other files of the service
+    reserved_paths = set(
+        os.path.abspath(path)
+        for path in [
+            config.options.out,
+            config.options.snapshot,
+            os.path.join(out_dir, shards_manifest),
+        ]
+        if path
+    )
+
+    paths = set()
+    for filename, configs in shards.items():
+        path = os.path.join(out_dir, filename)
+        if os.path.abspath(path) in reserved_paths:
+            logger.warning("Skipping shard %s, the file is reserved" % (
+                path,
+            ))
+            errors_counter.inc()
+            continue
+
+        paths.add(path)
+        await save_config_file(config, path, iter_configs_chunks(configs))
+
+    if config.shards_paths is None:
+        previous_paths = read_shards_manifest(out_dir)
+    else:
+        previous_paths = config.shards_paths
+
+    for path in previous_paths - paths:
+        if os.path.abspath(path) in reserved_paths:
+            continue
+
+        logger.info("Removing configuration %s" % (path,))
+        config.files_digests.pop(path, None)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    if paths != config.shards_paths:
+        manifest = "".join(
+            "%s\n" % (os.path.basename(path),)
+            for path in sorted(paths)
+        )
+        await write_file(
+            config,
+            os.path.join(out_dir, shards_manifest),
+            [manifest.encode('utf-8')]
+        )
+
+    config.shards_paths = paths
+
+
+def json_dumps(obj):
+    """
+    Serialize an object to compact json bytes with sorted keys.
+
+    orjson is used when installed, both backends give the same output.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+    return json.dumps(
+        obj,
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    ).encode('utf-8')
+
+
+def iter_configs_chunks(sd_configs, chunk_size=65536):
     """
-    logger.info("Configuration updated in %s" % (config.options.out))
+    Serialize the configs as a json list in chunks of about `chunk_size`
+    bytes.
+
+    Each config is serialized on its own when the chunks are consumed, so
+    the output can be written without being held in memory. The time
+    spent serializing is observed in the `serialize` build phase.
+    """
+    buffer = [b'[']
+    size = 1
+    elapsed = 0
+
+    for index, job_config in enumerate(sd_configs):
+        if index:
+            buffer.append(b',')
+            size += 1
+
+        started = time.perf_counter()
+        data = json_dumps(job_config)
+        elapsed += time.perf_counter() - started
+
+        buffer.append(data)
+        size += len(data)
+
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+
+    buffer.append(b']')
+    build_phase_duration.labels('serialize').observe(elapsed)
+    yield b''.join(buffer)
+
+
+def serialize_configs(sd_configs):
+    """
+    Returns the json serialized configs and their digest.
+
+    The configs are serialized with sorted keys so the same configs always
+    give the same output.
+    """
+    data = b''.join(iter_configs_chunks(sd_configs))
+    return data, hashlib.sha1(data).hexdigest()
+
+
+def publish_configs(config, data, digest):
+    """
+    Keep the serialized configs in memory for the http service discovery.
+    """
+    config.http_sd_data = data
+    config.http_sd_etag = '"%s"' % (digest,)
+
+
+async def save_config_file(config, path, chunks):
+    """
+    Save serialized configs in a single file.
+
+    When the output is the same as the last one written, the file is
+    left untouched so prometheus doesn't have to reload it.
+    """
+    previous_digest = config.files_digests.get(path)
+
+    with build_phase_duration.labels('write').time():
+        digest, size = await write_file(config, path, chunks, previous_digest)
+
+    if digest == previous_digest:
+        logger.debug("Configuration in %s is unchanged" % (path,))
+        writes_skipped_counter.inc()
+        return
+
+    logger.info("Configuration updated in %s" % (path,))
 
     build_counter.inc()
+    config_file_size.observe(size)
+
+    config.files_digests[path] = digest
+
+
+async def write_file(config, path, chunks, previous_digest=None):
+    """
+    Replace the content of a file atomically with the `chunks` of bytes.
+
+    The data is written in a temporary file of the same directory which
+    is then renamed over `path`, so prometheus never reads an empty or
+    partially written file. The chunks are hashed while they're written,
+    when the digest is `previous_digest` the temporary file is dropped
+    and the file is left untouched.
+
+    Returns the digest and the size of the content.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory,
+        prefix=".%s." % (os.path.basename(path),),
+        suffix=".tmp"
+    )
+    os.close(fd)
+
+    try:
+        # mkstemp creates files only readable by the current user
+        if os.path.exists(path):
+            mode = os.stat(path).st_mode & 0o777
+        else:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+
+        digest = hashlib.sha1()
+        offset = 0
+
+        async with AIOFile(tmp_path, "wb") as afp:
+            for chunk in chunks:
+                digest.update(chunk)
+                await afp.write(chunk, offset)
+                offset += len(chunk)
+
+            digest = digest.hexdigest()
+            unchanged = digest == previous_digest
+
+            if not unchanged and config.options.fsync == "always":
+                await afp.fsync()
+
+        if unchanged:
+            os.unlink(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return digest, offset
+
+
+def dump_snapshot_key(key):
+    """Returns the json compatible version of the key of an entry"""
+    if isinstance(key, frozenset):
+        return {"set": sorted(
+            (dump_snapshot_key(item) for item in key),
+            key=json.dumps
+        )}
+    if isinstance(key, tuple):
+        return [dump_snapshot_key(item) for item in key]
+    return key
+
+
+def load_snapshot_key(data):
+    """Returns the key of an entry dumped by `dump_snapshot_key`"""
+    if isinstance(data, dict):
+        return frozenset(load_snapshot_key(item) for item in data["set"])
+    if isinstance(data, list):
+        return tuple(load_snapshot_key(item) for item in data)
+    return data
+
+
+def get_snapshot_options(config):
+    """
+    Returns the options the entries of a snapshot depend on.
+    """
+    options = config.options
+
+    return {
+        "mode": options.mode,
+        "enabled_by_default": config.enabled_by_default,
+        "task_addresses": options.task_addresses,
+        "meta_labels": options.use_meta_labels,
+        "service_labels": options.service_labels,
+        "task_labels": options.task_labels,
+        "container_labels": options.container_labels,
+    }
+
 
-    async with AIOFile(config.options.out, "w") as afp:
-        logger.debug(sd_configs)
-        json_data = json.dumps(sd_configs)
-        file_size = len(json_data.encode('utf-8'))
-        config_file_size.observe(file_size)
-        await afp.write(json_data)
+def get_snapshot(config):
+    """
+    Returns the discovery state to persist in the `--snapshot` file.
+
+    The snapshot holds the entries with the keys of the objects they were
+    built from, like the versions of the services and their tasks, and
+    the addresses of the cached containers.
+    """
+    return {
+        "version": 1,
+        "options": get_snapshot_options(config),
+        "entries": [
+            [
+                entry.service_id,
+                entry.name,
+                dump_snapshot_key(entry.key),
+                [
+                    [
+                        job_config.job,
+                        job_config.targets,
+                        dict(zip(*job_config.labels)),
+                    ]
+                    for job_config in entry.jobs
+                ],
+            ]
+            for entry in config.services_entries.values()
+        ],
+        "containers": [
+            list(container)
+            for container in config.containers_cache.values()
+        ],
+    }
+
+
+def load_snapshot(config, data):
+    """
+    Restore the entries and the containers cache of a snapshot.
+
+    Returns False when the snapshot was taken with options that change
+    the scrape configs, like another mode or other meta labels.
+    """
+    snapshot = json.loads(data)
+
+    if snapshot.get("version") != 1:
+        return False
+    if snapshot["options"] != get_snapshot_options(config):
+        return False
+
+    entries = {}
+    for service_id, name, key, jobs in snapshot["entries"]:
+        jobs = [
+            ScrapeConfig(job, tuple(targets), intern_labels(labels))
+            for job, targets, labels in jobs
+        ]
+        entries[service_id] = ServiceEntry(
+            service_id, name, jobs, load_snapshot_key(key)
+        )
+
+    for container_id, name, labels, networks in snapshot["containers"]:
+        config.containers_cache.set(container_id, Container(
+            container_id,
+            name,
+            labels,
+            tuple(tuple(network) for network in networks)
+        ))
+
+    config.services_entries = entries
+    return True
+
+
+async def save_snapshot(config):
+    """
+    Write the snapshot of the discovery state in `--snapshot`.
+    """
+    path = config.options.snapshot
+    data = json_dumps(get_snapshot(config))
+
+    with build_phase_duration.labels('snapshot').time():
+        digest, size = await write_file(
+            config, path, [data], config.files_digests.get(path)
+        )
+
+    config.files_digests[path] = digest
+
+
+async def read_snapshot(config):
+    """
+    Restore the state of the `--snapshot` file if it changed since it was
+    last read or written and returns True if it was restored.
+    """
+    path = config.options.snapshot
+    if not os.path.exists(path):
+        return False
+
+    try:
+        async with AIOFile(path, 'rb') as afp:
+            data = await afp.read()
+
+        digest = hashlib.sha1(data).hexdigest()
+        if config.files_digests.get(path) == digest:
+            return False
+
+        if not load_snapshot(config, data):
+            logger.info("Ignoring snapshot %s of other options" % (path,))
+            return False
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.warning("Couldn't load snapshot %s" % (path,), exc_info=True)
+        errors_counter.inc()
+        return False
+
+    config.files_digests[path] = digest
+    return True
+
+
+async def restore_snapshot(config):
+    """
+    Load the `--snapshot` file and save its configs right away.
+
+    The outputs are valid as soon as the service starts. The following
+    full build reconciles the snapshot with docker and only rebuilds the
+    entries of the objects that changed in the meantime.
+    """
+    if not await read_snapshot(config):
+        return
+
+    configs = get_cached_configs(config)
+    logger.info("Restored %d configs from snapshot %s" % (
+        len(configs), config.options.snapshot
+    ))
+
+    await save_configs(config, configs)
+
+
+def get_events_filters(config):
+    """
+    Returns the filters of the docker events subscription.
+
+    The docker daemon only sends the container events that can change the
+    configs or the containers cache instead of the whole event stream.
+    """
+    return config.backend.get_events_filters()
+
+
+async def get_config_events(config, subscriber):
+    """
+    Wait for the next events that require the configs to be rebuilt.
+
+    When debouncing is enabled, the events received within the debounce
+    window of the previous one are returned in the same batch. The batch
+    is closed when the max delay since the first event is reached.
+    """
+    loop = config.loop
+    debounce = config.options.debounce / 1000.0
+    max_delay = config.options.debounce_max / 1000.0
+
+    events = []
+    deadline = None
+
+    while True:
+        if not events:
+            event = await subscriber.get()
+        else:
+            timeout = min(debounce, deadline - loop.time())
+            if timeout <= 0:
+                break
+
+            try:
+                event = await asyncio.wait_for(subscriber.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+        event_queue_depth.set(subscriber.queue.qsize())
+
+        if event is None:
+            if events:
+                # Handle the batch first, the end of the stream will be
+                # noticed on the next call
+                subscriber.queue.put_nowait(None)
+                break
+            raise ConnectionError("Docker events stream closed")
+
+        event_counter.inc()
+
+        evict_container(config, event)
+
+        if not config.backend.is_config_event(event):
+            continue
+
+        events.append(event)
+
+        if debounce <= 0:
+            break
+
+        if deadline is None:
+            deadline = loop.time() + max_delay
+
+    return events
+
+
+async def handle_events(config, events):
+    """
+    Rebuild and save the configs after a batch of events.
+    """
+    if config.services_loaded:
+        with build_duration.time():
+            configs = await load_events_update(config, events)
+
+        if configs is None:
+            events_dropped_counter.inc(len(events))
+            return
+    else:
+        with build_duration.time():
+            configs = await load_existing_services(config)
+
+    save_config_task = config.loop.create_task(save_configs(config, configs))
+    done, pending = await asyncio.wait([save_config_task])
+    logger.debug("Save config and event tasks completed")
+
+    observe_events_latency(events)
+
+
+def observe_events_latency(events):
+    """
+    Observe the delay between the events and the configs being saved.
+    """
+    now = time.time()
+
+    for event in events:
+        if "timeNano" in event:
+            event_latency.observe(max(0, now - event["timeNano"] / 1e9))
 
 
 async def listen_events(config):
     """
     Listen for events and recreate the config whenever a container start/stop
     """
+    if not config.backend.listens_events:
+        logger.info("The %s backend doesn't listen to events" % (
+            config.options.mode,
+        ))
+        # Only the resync updates the configs
+        await asyncio.Future()
+
     docker = config.get_client()
-    subscriber = docker.events.subscribe()
+    subscriber = docker.events.subscribe(
+        filters=json.dumps(get_events_filters(config))
+    )
 
     logger.info("Listening for docker events")
     try:
-        states = ["start", "stop"]
         while True:
-            event = await subscriber.get()
+            events = await get_config_events(config, subscriber)
 
-            event_counter.inc()
+            if len(events) > 1:
+                logger.debug("Coalesced %d events" % (len(events),))
+                events_coalesced_counter.inc(len(events) - 1)
 
-            # TODO check in swarm mode if the container is linked to a service
-            # TODO update configs based on containers if not swarm mode
-            if event["Type"] == "container" and event["status"] in states:
-                with build_duration.time():
-                    configs = await load_existing_services(config)
-                save_config_task = config.loop.create_task(save_configs(config, configs))
-                done, pending = await asyncio.wait([save_config_task])
-                logger.debug("Save config and event tasks completed")
+            async with config.build_lock:
+                await handle_events(config, events)
 
     except Exception as exc:
         logger.info("Something wrong happened", exc_info=True)
@@ -446,8 +1360,72 @@ async def save_all_configs(config):
     when the service starts. Or from time to time to keep things in
     sync in case an event was missed.
     """
-    configs = await load_existing_services(config)
-    await save_configs(config, configs)
+    async with config.build_lock:
+        configs = await load_existing_services(config)
+        await save_configs(config, configs)
+
+
+def get_configs_drift(previous_configs, configs):
+    """
+    Returns the amount of scrape configs found in only one of the lists.
+    """
+    previous = collections.Counter(
+        json.dumps(job_config, sort_keys=True)
+        for job_config in previous_configs
+    )
+    current = collections.Counter(
+        json.dumps(job_config, sort_keys=True)
+        for job_config in configs
+    )
+
+    return sum(((previous - current) + (current - previous)).values())
+
+
+async def resync_configs_once(config):
+    """
+    Rebuild all the configs and record the drift with the configs that
+    were in memory in the `promsd_resync_drift` metric.
+    """
+    async with config.build_lock:
+        loaded = config.services_loaded
+        previous_configs = get_cached_configs(config)
+
+        with build_duration.time():
+            configs = await load_existing_services(config)
+
+        resync_counter.inc()
+
+        if loaded:
+            drift = get_configs_drift(previous_configs, configs)
+            resync_drift.set(drift)
+
+            if drift:
+                logger.warning(
+                    "Resync found %d outdated configs" % (drift,)
+                )
+
+        await save_configs(config, configs)
+
+
+async def resync_configs(config):
+    """
+    Periodically rebuild all the configs every `--resync-interval` seconds.
+
+    Events can be missed when the event stream reconnects. The full build
+    fixes the configs built incrementally and the difference with the
+    configs in memory is recorded in the `promsd_resync_drift` metric.
+    """
+    while True:
+        await asyncio.sleep(config.options.resync_interval)
+
+        try:
+            await resync_configs_once(config)
+        except asyncio.CancelledError:
+            # CancelledError is an Exception before python 3.8
+            raise
+        except Exception:
+            logger.info("Resync failed", exc_info=True)
+            errors_counter.inc()
 
 
 async def main_loop(config):
@@ -465,21 +1443,45 @@ async def main_loop(config):
     and step 2 completes with an exception
 
     In a perfect world, it should not loop more than 1 time.
+
+    When the tasks keep failing, for example when the docker socket isn't
+    available, each restart is delayed with an exponential backoff and
+    the circuit breaker opens after `--breaker-threshold` failures.
+    An iteration lasting longer than `--backoff-max` is considered
+    healthy and resets the backoff.
     """
     logger.info("Entering main loop")
 
     reinit_count = 0
     loop = config.loop
 
+    breaker = CircuitBreaker(
+        min_delay=config.options.backoff_min,
+        max_delay=config.options.backoff_max,
+        threshold=config.options.breaker_threshold,
+        gauge=circuit_breaker_state,
+    )
+
     config.init()
 
+    if config.options.snapshot:
+        await restore_snapshot(config)
+
     while True:
         if reinit_count > 0:
             logger.info("Reinit mainloop %d" % (reinit_count))
 
+        await breaker.wait()
+
+        started = loop.time()
+
         save_config_task = loop.create_task(save_all_configs(config))
         read_events_task = loop.create_task(listen_events(config))
 
+        resync_task = None
+        if config.options.resync_interval > 0:
+            resync_task = loop.create_task(resync_configs(config))
+
         # TODO check if all done tasks are completed with errors or not
         # In theory it should always return in errors so make sure we don't miss
         # an error log
@@ -487,13 +1489,22 @@ async def main_loop(config):
             [save_config_task, read_events_task]
         )
 
+        if resync_task is not None:
+            resync_task.cancel()
+
+        if loop.time() - started >= config.options.backoff_max:
+            # A long iteration was healthy, restart without any delay
+            breaker.success()
+        else:
+            breaker.failure()
 
         reinit_counter.inc()
 
         reinit_count += 1
 
-        # TODO add a way to prevent spinning in case the loop jobs fails quickly
-        # in case reinit_count changes quickly we can probably add a sleep call
-        # that will stabilize to 1 reset per second just in case while spitting errors
+        if breaker.state == CircuitBreaker.OPEN:
+            logger.warning(
+                "Circuit breaker open after %d failures" % (breaker.failures,)
+            )
 
     await config.deinit()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from prometheus_sd.backoff import CircuitBreaker
+
+
+class GaugeMock(object):
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+
+def test_backoff_delay():
+    breaker = CircuitBreaker(min_delay=1, max_delay=8, threshold=10)
+
+    assert breaker.get_delay() == 0
+
+    breaker.failure()
+    assert 0.5 <= breaker.get_delay() <= 1
+
+    breaker.failure()
+    breaker.failure()
+    assert 2 <= breaker.get_delay() <= 4
+
+    for i in range(5):
+        breaker.failure()
+    assert 4 <= breaker.get_delay() <= 8
+
+    breaker.success()
+    assert breaker.get_delay() == 0
+
+
+async def test_circuit_breaker_states():
+    gauge = GaugeMock()
+    breaker = CircuitBreaker(
+        min_delay=0, max_delay=0, threshold=2, gauge=gauge
+    )
+
+    assert gauge.value == CircuitBreaker.CLOSED
+
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.failure()
+    assert gauge.value == CircuitBreaker.OPEN
+    assert breaker.get_delay() == breaker.max_delay
+
+    await breaker.wait()
+    assert gauge.value == CircuitBreaker.HALF_OPEN
+
+    breaker.failure()
+    assert gauge.value == CircuitBreaker.OPEN
+
+    await breaker.wait()
+    breaker.success()
+    assert gauge.value == CircuitBreaker.CLOSED
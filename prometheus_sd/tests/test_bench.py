@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from prometheus_sd.bench.fake import FakeDocker
+from prometheus_sd.bench.runner import get_bench_parser, run_benchmarks
+
+
+def test_fake_docker():
+    docker = FakeDocker(services=2, tasks=3, labels=5)
+
+    assert len(docker.services_data) == 2
+    assert len(docker.tasks_data) == 6
+    assert len(docker.containers_data) == 6
+
+    service = list(docker.services_data.values())[0]
+    assert len(service["Spec"]["Labels"]) == 9
+
+    subscriber = docker.events.subscribe()
+    docker.storm(2)
+
+    assert subscriber.queue.qsize() == 4
+    assert len(docker.tasks_data) == 6
+
+
+async def test_run_benchmarks():
+    parser = get_bench_parser()
+    options, args = parser.parse_args([
+        '--services', '5',
+        '--events', '3',
+        '--latency', '0',
+        '--', '--incremental',
+    ])
+
+    results = await run_benchmarks(options, args)
+
+    assert len(results) == 4
+    assert results[0].calls["containers.get"] == 15
+    assert "containers.get" not in results[1].calls
+    assert results[3].calls["services.inspect"] == 6
+    assert results[0].output_size > 0
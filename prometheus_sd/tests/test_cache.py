@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from prometheus_sd.cache import LRUCache
+
+
+def test_cache_eviction():
+    cache = LRUCache(2)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    # a becomes the most recently used
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('c') == 3
+
+
+def test_cache_pop():
+    cache = LRUCache(2)
+
+    cache.set('a', 1)
+
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    assert cache.get('a', 5) == 5
+
+
+def test_cache_disabled():
+    cache = LRUCache(0)
+
+    cache.set('a', 1)
+
+    assert len(cache) == 0
+    assert cache.get('a') is None
+
+
+def test_cache_values():
+    cache = LRUCache(3)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+
+    assert cache.values() == [2, 1]
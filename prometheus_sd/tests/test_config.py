@@ -43,6 +43,17 @@ def test_config_minimal_self_init():
     assert config.inited == True
 
 
+def test_config_task_addresses_container_labels():
+    parser = get_parser()
+    args = ['--out', 'text.json', '--task-addresses']
+
+    config = Config(parser, args, DockerClientMock)
+    assert config.validate() == True
+
+    config = Config(parser, args + ['--container-labels'], DockerClientMock)
+    assert config.validate() == False
+
+
 def test_config_metrics_config():
     parser = get_parser()
 
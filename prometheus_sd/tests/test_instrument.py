@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from prometheus_sd.bench.fake import FakeDocker
+from prometheus_sd.instrument import InstrumentedDocker
+from prometheus_sd.metrics import docker_api_calls, docker_api_in_flight
+
+
+async def test_instrumented_docker():
+    fake = FakeDocker(services=2, tasks=1)
+    docker = InstrumentedDocker(fake)
+
+    counter = docker_api_calls.labels('services.list')
+    calls = counter._value.get()
+
+    services = await docker.services.list()
+
+    assert len(services) == 2
+    assert counter._value.get() == calls + 1
+    assert docker_api_in_flight._value.get() == 0
+    assert fake.calls["services.list"] == 1
+
+    # Subscriptions to the events stream are counted
+    counter = docker_api_calls.labels('events.subscribe')
+    calls = counter._value.get()
+
+    subscriber = docker.events.subscribe()
+    assert subscriber.queue.qsize() == 0
+    assert counter._value.get() == calls + 1
+
+    # Other attributes aren't instrumented
+    assert docker.latency == 0
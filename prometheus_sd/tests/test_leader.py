@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import pytest
+import asyncio
+import json
+
+from prometheus_sd.config import Config, get_parser
+from prometheus_sd.leader import LockFile, load_leader_output, wait_leadership
+from prometheus_sd.service import ScrapeConfig, ServiceEntry, save_snapshot
+
+
+def test_lock_file(tmp_path):
+    path = str(tmp_path / "promsd.lock")
+
+    leader = LockFile(path)
+    follower = LockFile(path)
+
+    assert leader.acquire()
+    assert leader.locked
+    assert not follower.acquire()
+    assert not follower.locked
+
+    leader.release()
+    assert follower.acquire()
+
+    follower.release()
+
+
+async def test_load_leader_output(tmp_path):
+    out = tmp_path / "out.json"
+    configs = [{"labels": {"job": "main"}, "targets": ["10.0.0.1:9090"]}]
+    out.write_text(json.dumps(configs, indent=2))
+
+    config = Config(get_parser(), ['--out', str(out), '--http-sd'])
+
+    await load_leader_output(config)
+
+    assert json.loads(config.http_sd_data) == configs
+    assert str(out) in config.files_digests
+
+
+async def test_load_leader_snapshot(tmp_path):
+    snapshot = str(tmp_path / "snapshot.json")
+
+    leader = Config(get_parser(), ['--http-sd', '--snapshot', snapshot])
+    leader.services_entries["web_id"] = ServiceEntry("web_id", "web", [
+        ScrapeConfig("main", ("10.0.0.1:9090",), (("job",), ("main",)))
+    ], "web_id")
+    await save_snapshot(leader)
+
+    follower = Config(get_parser(), ['--http-sd', '--snapshot', snapshot])
+
+    await load_leader_output(follower)
+
+    assert json.loads(follower.http_sd_data) == [
+        {"labels": {"job": "main"}, "targets": ["10.0.0.1:9090"]}
+    ]
+    assert follower.services_entries["web_id"].key == "web_id"
+    assert not follower.services_loaded
+
+
+async def test_wait_leadership(tmp_path):
+    path = str(tmp_path / "promsd.lock")
+    config = Config(get_parser(), [
+        '--out', str(tmp_path / "out.json"),
+        '--lock-file', path,
+        '--lock-interval', '0.01',
+    ])
+
+    leader = LockFile(path)
+    assert leader.acquire()
+
+    follower = LockFile(path)
+    task = asyncio.ensure_future(wait_leadership(config, follower))
+
+    await asyncio.sleep(0.05)
+    assert not task.done()
+
+    leader.release()
+    await asyncio.wait_for(task, 1)
+    assert follower.locked
+
+    follower.release()
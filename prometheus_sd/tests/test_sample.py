@@ -5,6 +5,7 @@ from prometheus_sd.utils import (
     extract_prometheus_labels,
     dotted_setter,
     convert_labels_to_config,
+    parse_prometheus_config,
     labels_prefix,
     format_label
 )
@@ -45,6 +46,40 @@ def test_multi_value():
     assert ctx.get('a', {}).get('c', {}).get('c') == 3
     assert ctx.get('a', {}).get('c', {}).get('f') == 4
 
+def test_convert_labels_to_config():
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+        "prometheus.jobs.main.params.a": "1",
+        "prometheus.jobs.other.path": "/metrics2",
+    }
+
+    config = convert_labels_to_config(labels)
+
+    assert config == {
+        "prometheus": {
+            "enable": "true",
+            "jobs": {
+                "main": {"port": "9090", "params": {"a": "1"}},
+                "other": {"path": "/metrics2"},
+            }
+        }
+    }
+
+
+def test_parse_prometheus_config_cache():
+    labels = {
+        "com.docker.stack.namespace": "stack",
+        "prometheus.jobs.main.port": "9090",
+    }
+
+    config = parse_prometheus_config(labels)
+    assert config == {"prometheus": {"jobs": {"main": {"port": "9090"}}}}
+
+    other_labels = dict(labels, **{"com.docker.stack.namespace": "other"})
+    assert parse_prometheus_config(other_labels) is config
+
+
 def test_format_label():
 
     assert format_label('service', 'id') == "__meta_docker_service_label_id"
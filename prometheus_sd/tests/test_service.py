@@ -1,25 +1,56 @@
 # -*- coding: utf-8 -*-
 import pytest
+import os
+import time
+import json
+import asyncio
+from aiodocker.exceptions import DockerError
+from prometheus_sd.backoff import CircuitBreaker
+from prometheus_sd.config import Config, get_parser
+from prometheus_sd.metrics import (
+    registry,
+    resync_drift,
+    writes_skipped_counter,
+)
 from prometheus_sd.service import (
     filter_tasks,
+    get_container_meta_labels,
+    get_container_name,
+    get_service_meta_labels,
+    get_task_meta_labels,
+    get_config_events,
+    get_configs_drift,
+    get_cached_configs,
+    get_event_service_id,
+    get_events_filters,
     get_hosts,
-    Target
+    handle_events,
+    iter_configs_chunks,
+    load_existing_services,
+    main_loop,
+    resync_configs,
+    resync_configs_once,
+    restore_snapshot,
+    save_configs,
+    save_shards,
+    write_file,
+    Container,
+    ScrapeConfig,
+    Target,
 )
 
 
 def test_get_hosts_empty():
     prom_config = {
     }
-    service = {}
-
-    hosts = get_hosts(prom_config, service)
+    hosts = get_hosts(prom_config)
     assert len(hosts) == 0
 
     prom_config = {
         'hosts': ''
     }
 
-    hosts = get_hosts(prom_config, service)
+    hosts = get_hosts(prom_config)
     assert len(hosts) == 0
 
 
@@ -27,26 +58,16 @@ def test_get_hosts():
     prom_config = {
         'hosts': 'localhost:9090,127.0.0.1:8080,www.example.com'
     }
-    service = {}
-
-    hosts = get_hosts(prom_config, service)
-    assert len(hosts) == 1
-    assert 'localhost:9090' in hosts[0].hosts
-    assert '127.0.0.1:8080' in hosts[0].hosts
-    assert 'www.example.com' in hosts[0].hosts
+    hosts = get_hosts(prom_config)
+    assert hosts == ('localhost:9090', '127.0.0.1:8080', 'www.example.com')
 
 
 def test_get_hosts2():
     prom_config = {
         'hosts': 'localhost:9090 , 127.0.0.1:8080 ,www.example.com  '
     }
-    service = {}
-
-    hosts = get_hosts(prom_config, service)
-    assert len(hosts) == 1
-    assert 'localhost:9090' in hosts[0].hosts
-    assert '127.0.0.1:8080' in hosts[0].hosts
-    assert 'www.example.com' in hosts[0].hosts
+    hosts = get_hosts(prom_config)
+    assert hosts == ('localhost:9090', '127.0.0.1:8080', 'www.example.com')
 
 
 def test_filter_tasks():
@@ -70,16 +91,934 @@ def test_filter_tasks():
 
 
 def test_empty_target():
-    target = Target()
-
-    c_labels = target.get_container_labels()
+    c_labels = get_container_meta_labels(None)
     assert isinstance(c_labels, dict)
     assert len(c_labels.keys()) == 0
 
-    t_labels = target.get_task_labels()
+    t_labels = get_task_meta_labels(None)
     assert isinstance(t_labels, dict)
     assert len(t_labels.keys()) == 0
 
-    s_labels = target.get_service_labels()
+    s_labels = get_service_meta_labels(None)
     assert isinstance(s_labels, dict)
     assert len(s_labels.keys()) == 0
+
+    options = get_parser().parse_args([])[0]
+    target = Target.from_objects(options)
+    assert target.networks == ()
+    assert target.context == ((), ())
+
+
+class ContainerMock(object):
+    def __init__(self, data):
+        self._container = data
+
+
+class DockerMock(object):
+    """
+    Minimal docker client exposing a fake swarm.
+    """
+    def __init__(self, url=None):
+        self.url = url
+        self.services_data = []
+        self.tasks_data = []
+        self.containers_data = {}
+        self.standalone_ids = []
+        self.calls = []
+
+        self.services = self
+        self.tasks = self
+        self.containers = self
+
+    def add_service(self, name, labels, ips):
+        service_id = "%s_id" % (name,)
+        self.services_data.append({
+            "ID": service_id,
+            "Spec": {"Name": name, "Labels": labels},
+        })
+
+        for ip in ips:
+            self.add_task(service_id, name, ip)
+
+        return service_id
+
+    def add_task(self, service_id, name, ip):
+        index = len(self.tasks_data)
+        container_id = "%s_container_%d" % (name, index)
+        self.tasks_data.append({
+            "ID": "%s_task_%d" % (name, index),
+            "ServiceID": service_id,
+            "ServiceName": name,
+            "Labels": {},
+            "Status": {
+                "State": "running",
+                "ContainerStatus": {"ContainerID": container_id}
+            },
+            "NetworksAttachments": [
+                {
+                    "Network": {"Spec": {"Name": "default"}},
+                    "Addresses": ["%s/24" % (ip,)],
+                }
+            ],
+        })
+        self.containers_data[container_id] = {
+            "Id": container_id,
+            "Config": {"Labels": {}},
+            "NetworkSettings": {
+                "Networks": {"default": {"IPAddress": ip}}
+            },
+        }
+
+    def add_container(self, name, labels, ip):
+        container_id = "%s_id" % (name,)
+        self.standalone_ids.append(container_id)
+        self.containers_data[container_id] = {
+            "Id": container_id,
+            "Name": "/%s" % (name,),
+            "Config": {"Labels": labels},
+            "NetworkSettings": {
+                "Networks": {"bridge": {"IPAddress": ip}}
+            },
+        }
+        return container_id
+
+    async def list(self, filters=None):
+        if isinstance(filters, str):
+            self.calls.append("containers.list")
+            filters = json.loads(filters)
+            containers = []
+            for container_id in self.standalone_ids:
+                data = self.containers_data[container_id]
+                labels = data["Config"]["Labels"]
+                if "label" in filters and labels.get("prometheus.enable") != "true":
+                    continue
+                containers.append(ContainerMock({
+                    "Id": container_id,
+                    "Names": [data["Name"]],
+                    "Labels": labels,
+                    "NetworkSettings": data["NetworkSettings"],
+                }))
+            return containers
+
+        if filters is None:
+            self.calls.append("services.list")
+            return self.services_data
+
+        self.calls.append("tasks.list")
+        return [
+            task
+            for task in self.tasks_data
+            if task["ServiceName"] == filters.get("service", task["ServiceName"])
+        ]
+
+    async def inspect(self, service_id):
+        self.calls.append("services.inspect")
+        for service in self.services_data:
+            if service["ID"] == service_id:
+                return service
+        raise DockerError(404, {"message": "service not found"})
+
+    async def get(self, container_id):
+        self.calls.append("containers.get")
+        if container_id not in self.containers_data:
+            raise DockerError(404, {"message": "container not found"})
+        return ContainerMock(self.containers_data[container_id])
+
+
+def get_swarm_config(args=None):
+    parser = get_parser()
+    config = Config(parser, ['--out', 'text.json'] + (args or []), DockerMock)
+    return config
+
+
+async def test_load_service_update():
+    config = get_swarm_config(['--incremental'])
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    web_id = docker.add_service("web", labels, ["10.0.0.1"])
+    docker.add_service("db", labels, ["10.0.0.2"])
+
+    configs = await load_existing_services(config)
+    assert len(configs) == 2
+    assert config.services_loaded
+    assert docker.calls.count("tasks.list") == 1
+
+    docker.calls.clear()
+    docker.add_task(web_id, "web", "10.0.0.3")
+
+    await config.backend.update_services([web_id])
+    configs = get_cached_configs(config)
+    targets = [target for job in configs for target in job["targets"]]
+
+    assert "services.list" not in docker.calls
+    assert docker.calls.count("tasks.list") == 1
+    assert sorted(targets) == [
+        "10.0.0.1:9090", "10.0.0.2:9090", "10.0.0.3:9090"
+    ]
+
+
+async def test_load_existing_services_phases():
+    config = get_swarm_config()
+    docker = config.get_client()
+    docker.add_service("web", {"prometheus.enable": "true"}, ["10.0.0.1"])
+
+    def get_count(phase):
+        return registry.get_sample_value(
+            'promsd_build_phase_seconds_count', {'phase': phase}
+        ) or 0
+
+    service_list = get_count('service_list')
+    task_list = get_count('task_list')
+
+    await load_existing_services(config)
+
+    assert get_count('service_list') == service_list + 1
+    assert get_count('task_list') == task_list + 1
+
+
+async def test_load_service_update_removed():
+    config = get_swarm_config(['--incremental'])
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    web_id = docker.add_service("web", labels, ["10.0.0.1"])
+    docker.add_service("db", labels, ["10.0.0.2"])
+
+    await load_existing_services(config)
+
+    docker.services_data.pop(0)
+    await config.backend.update_services([web_id])
+    configs = get_cached_configs(config)
+
+    assert len(configs) == 1
+    assert configs[0]["targets"] == ["10.0.0.2:9090"]
+
+
+async def test_load_existing_services_dead_container():
+    config = get_swarm_config()
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_service("web", labels, ["10.0.0.1", "10.0.0.2"])
+    docker.containers_data.pop("web_container_0")
+
+    configs = await load_existing_services(config)
+
+    assert len(configs) == 1
+    assert configs[0]["targets"] == ["10.0.0.2:9090"]
+
+
+async def test_load_existing_services_inspect_failed():
+    config = get_swarm_config()
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_service("web", labels, ["10.0.0.1", "10.0.0.2"])
+    container = docker.containers_data.pop("web_container_0")
+
+    configs = await load_existing_services(config)
+    assert len(configs) == 1
+    assert config.services_entries["web_id"].key is None
+
+    # The inspect works again while the tasks are unchanged
+    docker.containers_data["web_container_0"] = container
+
+    configs = await load_existing_services(config)
+    targets = [target for job in configs for target in job["targets"]]
+
+    assert sorted(targets) == ["10.0.0.1:9090", "10.0.0.2:9090"]
+    assert config.services_entries["web_id"].key is not None
+
+
+async def test_container_cache():
+    config = get_swarm_config()
+    config.loop = asyncio.get_event_loop()
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_service("web", labels, ["10.0.0.1", "10.0.0.2"])
+
+    await load_existing_services(config)
+    assert docker.calls.count("containers.get") == 2
+
+    docker.calls.clear()
+    await load_existing_services(config)
+    assert docker.calls.count("containers.get") == 0
+
+    event = make_event("die", "web_id")
+    event["Actor"]["ID"] = "web_container_0"
+    subscriber = SubscriberMock([event, make_event("start", "web_id")])
+    await get_config_events(config, subscriber)
+
+    assert "web_container_0" not in config.containers_cache
+
+    # The task status got updated
+    docker.tasks_data[0]["Version"] = {"Index": 2}
+
+    docker.calls.clear()
+    await load_existing_services(config)
+    assert docker.calls.count("containers.get") == 1
+
+
+def test_get_events_filters():
+    config = get_swarm_config()
+    filters = get_events_filters(config)
+
+    assert filters["type"] == ["container"]
+    assert filters["event"] == ["destroy", "die", "start", "stop"]
+    assert "label" not in filters
+
+    config = get_swarm_config(['--swarm-events-only'])
+    filters = get_events_filters(config)
+
+    assert filters["label"] == ["com.docker.swarm.service.id"]
+
+
+def test_get_event_service_id():
+    event = {
+        "Type": "container",
+        "status": "start",
+        "Actor": {
+            "ID": "abc",
+            "Attributes": {"com.docker.swarm.service.id": "srv"}
+        }
+    }
+    assert get_event_service_id(event) == "srv"
+    assert get_event_service_id({"Type": "container"}) is None
+
+
+class SubscriberMock(object):
+    def __init__(self, events):
+        self.queue = asyncio.Queue()
+        for event in events:
+            self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+def make_event(status, service_id=None, event_type="container"):
+    return {
+        "Type": event_type,
+        "status": status,
+        "Actor": {
+            "Attributes": {"com.docker.swarm.service.id": service_id}
+        }
+    }
+
+
+async def test_get_config_events():
+    config = get_swarm_config()
+    config.loop = asyncio.get_event_loop()
+
+    subscriber = SubscriberMock([
+        make_event("start", "a"),
+        make_event("stop", "b"),
+    ])
+
+    events = await get_config_events(config, subscriber)
+    assert len(events) == 1
+
+
+async def test_get_config_events_debounce():
+    config = get_swarm_config(['--debounce', '20'])
+    config.loop = asyncio.get_event_loop()
+
+    subscriber = SubscriberMock([
+        make_event("start", "a"),
+        make_event("create", "c", "network"),
+        make_event("stop", "b"),
+        make_event("exec_start", "b"),
+    ])
+
+    events = await get_config_events(config, subscriber)
+    assert [event["status"] for event in events] == ["start", "stop"]
+
+
+async def test_get_config_events_stream_closed():
+    config = get_swarm_config(['--debounce', '1000'])
+    config.loop = asyncio.get_event_loop()
+
+    subscriber = SubscriberMock([make_event("start", "a"), None])
+
+    events = await get_config_events(config, subscriber)
+    assert [event["status"] for event in events] == ["start"]
+
+    with pytest.raises(ConnectionError):
+        await get_config_events(config, subscriber)
+
+
+async def test_save_configs_unchanged(tmp_path):
+    out = str(tmp_path / "out.json")
+    parser = get_parser()
+    config = Config(parser, ['--out', out], DockerMock)
+
+    sd_configs = [{"labels": {"job": "main"}, "targets": ["10.0.0.1:80"]}]
+
+    await save_configs(config, sd_configs)
+
+    with open(out, "w") as fout:
+        fout.write("modified")
+
+    skipped = writes_skipped_counter._value.get()
+    await save_configs(config, sd_configs)
+
+    assert writes_skipped_counter._value.get() == skipped + 1
+    with open(out) as fin:
+        assert fin.read() == "modified"
+
+    sd_configs[0]["targets"].append("10.0.0.2:80")
+    await save_configs(config, sd_configs)
+
+    with open(out) as fin:
+        assert len(json.loads(fin.read())[0]["targets"]) == 2
+
+
+async def test_write_file(tmp_path):
+    out = str(tmp_path / "out.json")
+    parser = get_parser()
+    config = Config(parser, ['--out', out, '--fsync', 'never'], DockerMock)
+
+    await write_file(config, out, [b"[", b"]"])
+    with open(out) as fin:
+        assert fin.read() == "[]"
+
+    os.chmod(out, 0o640)
+    digest, size = await write_file(config, out, [b"[{}]"])
+
+    with open(out) as fin:
+        assert fin.read() == "[{}]"
+    assert size == 4
+    assert os.stat(out).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmp_path)) == ["out.json"]
+
+    inode = os.stat(out).st_ino
+    assert await write_file(config, out, [b"[{", b"}]"], digest) == (digest, 4)
+    assert os.stat(out).st_ino == inode
+    assert os.listdir(str(tmp_path)) == ["out.json"]
+
+
+async def test_save_shards_by_job(tmp_path):
+    parser = get_parser()
+    config = Config(parser, ['--out-dir', str(tmp_path)], DockerMock)
+
+    with open(str(tmp_path / "stale.json"), "w") as fout:
+        fout.write("[]")
+
+    sd_configs = [
+        {"labels": {"job": "web"}, "targets": ["10.0.0.1:80"]},
+        {"labels": {"job": "web"}, "targets": ["10.0.0.2:80"]},
+        {"labels": {"job": "db/main"}, "targets": ["10.0.0.3:80"]},
+    ]
+
+    await save_configs(config, sd_configs)
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        ".promsd-shards", "db_main.json", "stale.json", "web.json"
+    ]
+    with open(str(tmp_path / "web.json")) as fin:
+        assert len(json.loads(fin.read())) == 2
+
+    await save_shards(config, sd_configs[:2])
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        ".promsd-shards", "stale.json", "web.json"
+    ]
+
+    # Shards of a previous run are removed on restart
+    config = Config(parser, ['--out-dir', str(tmp_path)], DockerMock)
+    await save_shards(config, sd_configs[2:])
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        ".promsd-shards", "db_main.json", "stale.json"
+    ]
+
+
+async def test_save_shards_keep_out(tmp_path):
+    out = str(tmp_path / "all.json")
+    parser = get_parser()
+    config = Config(
+        parser, ['--out', out, '--out-dir', str(tmp_path)], DockerMock
+    )
+
+    sd_configs = [
+        {"labels": {"job": "web"}, "targets": ["10.0.0.1:80"]},
+        {"labels": {"job": "all"}, "targets": ["10.0.0.2:80"]},
+    ]
+
+    await save_configs(config, sd_configs)
+
+    # The "all" shard would overwrite the output file
+    with open(out) as fin:
+        assert json.loads(fin.read()) == sd_configs
+
+    await save_configs(config, sd_configs[:1])
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        ".promsd-shards", "all.json", "web.json"
+    ]
+    with open(out) as fin:
+        assert json.loads(fin.read()) == sd_configs[:1]
+
+
+async def test_save_shards_by_service(tmp_path):
+    config = get_swarm_config([
+        '--out-dir', str(tmp_path),
+        '--shard-by', 'service',
+    ])
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_service("web", labels, ["10.0.0.1"])
+    docker.add_service("db", labels, ["10.0.0.2"])
+
+    configs = await load_existing_services(config)
+    await save_shards(config, configs)
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        ".promsd-shards", "db.json", "web.json"
+    ]
+
+
+def test_get_configs_drift():
+    web = {"labels": {"job": "web"}, "targets": ["10.0.0.1:80"]}
+    db = {"labels": {"job": "db"}, "targets": ["10.0.0.2:80"]}
+    db2 = {"targets": ["10.0.0.2:80"], "labels": {"job": "db"}}
+
+    assert get_configs_drift([web, db], [db2, web]) == 0
+    assert get_configs_drift([web], [web, db]) == 1
+    assert get_configs_drift([web, db], []) == 2
+
+
+async def test_resync_configs(tmp_path):
+    config = get_swarm_config(['--out', str(tmp_path / "out.json")])
+    config.loop = asyncio.get_event_loop()
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    web_id = docker.add_service("web", labels, ["10.0.0.1"])
+    await load_existing_services(config)
+
+    # Missed event
+    docker.add_task(web_id, "web", "10.0.0.2")
+
+    await resync_configs_once(config)
+
+    assert len(get_cached_configs(config)) == 2
+    assert resync_drift._value.get() == 1
+
+    with open(str(tmp_path / "out.json")) as fin:
+        assert len(json.loads(fin.read())) == 2
+
+    await resync_configs_once(config)
+    assert resync_drift._value.get() == 0
+
+
+async def test_resync_configs_cancelled():
+    config = get_swarm_config(['--resync-interval', '0'])
+    config.loop = asyncio.get_event_loop()
+
+    await config.build_lock.acquire()
+    task = config.loop.create_task(resync_configs(config))
+    await asyncio.sleep(0.01)
+
+    # Cancelled while waiting for the build lock
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    config.build_lock.release()
+
+
+async def test_load_existing_services_task_addresses():
+    config = get_swarm_config(['--task-addresses'])
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+        "prometheus.jobs.main.networks": "default",
+    }
+    docker.add_service("web", labels, ["10.0.0.1", "10.0.0.2"])
+    docker.tasks_data[1]["Status"]["State"] = "preparing"
+
+    configs = await load_existing_services(config)
+
+    assert "containers.get" not in docker.calls
+    assert len(configs) == 1
+    assert configs[0]["targets"] == ["10.0.0.1:9090"]
+
+
+async def test_load_existing_services_unchanged():
+    config = get_swarm_config()
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    web_id = docker.add_service("web", labels, ["10.0.0.1"])
+    db_id = docker.add_service("db", labels, ["10.0.0.2"])
+
+    await load_existing_services(config)
+    web_entry = config.services_entries[web_id]
+    db_entry = config.services_entries[db_id]
+
+    docker.add_task(web_id, "web", "10.0.0.3")
+    docker.services_data[1]["Version"] = {"Index": 2}
+
+    configs = await load_existing_services(config)
+
+    assert len(configs) == 3
+    assert config.services_entries[web_id] is not web_entry
+    assert config.services_entries[db_id] is not db_entry
+
+    web_entry = config.services_entries[web_id]
+    await load_existing_services(config)
+
+    assert config.services_entries[web_id] is web_entry
+
+
+def test_target_meta_labels_cache():
+    service = {
+        "ID": "web_id",
+        "Version": {"Index": 1},
+        "Spec": {"Labels": {"a.b": "1"}},
+    }
+
+    labels = get_service_meta_labels(service)
+    assert labels == {"__meta_docker_service_label_a_b": "1"}
+    assert get_service_meta_labels(service) is labels
+
+    service = {
+        "ID": "web_id",
+        "Version": {"Index": 2},
+        "Spec": {"Labels": {"a.b": "2"}},
+    }
+
+    assert get_service_meta_labels(service) == {
+        "__meta_docker_service_label_a_b": "2"
+    }
+
+
+async def test_handle_events_latency(tmp_path):
+    config = get_swarm_config([
+        '--out', str(tmp_path / "out.json"),
+        '--incremental',
+    ])
+    config.loop = asyncio.get_event_loop()
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    web_id = docker.add_service("web", labels, ["10.0.0.1"])
+    await load_existing_services(config)
+
+    def get_sample(name):
+        return registry.get_sample_value(name) or 0
+
+    latency_count = get_sample('promsd_event_latency_seconds_count')
+    dropped = get_sample('promsd_events_dropped_total')
+
+    event = make_event("start", web_id)
+    event["timeNano"] = int((time.time() - 1) * 1e9)
+    await handle_events(config, [event])
+
+    assert get_sample('promsd_event_latency_seconds_count') == latency_count + 1
+    assert get_sample('promsd_event_latency_seconds_sum') >= 1
+
+    await handle_events(config, [make_event("start")])
+    assert get_sample('promsd_events_dropped_total') == dropped + 1
+
+
+def test_iter_configs_chunks():
+    sd_configs = [
+        {"targets": ["10.0.0.%d:80" % (index,)], "labels": {"job": "web"}}
+        for index in range(100)
+    ]
+
+    chunks = list(iter_configs_chunks(sd_configs, chunk_size=256))
+
+    assert len(chunks) > 1
+    assert json.loads(b"".join(chunks).decode('utf-8')) == sd_configs
+    assert list(iter_configs_chunks([])) == [b"[]"]
+
+
+def make_container_event(status, container_id, labels=None):
+    return {
+        "Type": "container",
+        "status": status,
+        "id": container_id,
+        "Actor": {"ID": container_id, "Attributes": labels or {}},
+    }
+
+
+async def test_container_mode(tmp_path):
+    config = get_swarm_config(['--mode', 'container'])
+    config.loop = asyncio.get_event_loop()
+    config.options.out = str(tmp_path / "out.json")
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_container("web", labels, "172.17.0.2")
+    docker.add_container("db", {}, "172.17.0.3")
+
+    configs = await load_existing_services(config)
+
+    assert docker.calls == ["containers.list"]
+    assert len(configs) == 1
+    assert configs[0]["labels"]["job"] == "main"
+    assert configs[0]["targets"] == ["172.17.0.2:9090"]
+    assert config.services_entries["web_id"].name == "web"
+
+    docker.calls.clear()
+    api_id = docker.add_container("api", labels, "172.17.0.4")
+    await handle_events(config, [
+        make_container_event("start", api_id, labels),
+        make_container_event("start", "db_id"),
+        make_container_event("die", "web_id", labels),
+    ])
+
+    configs = get_cached_configs(config)
+    assert docker.calls == ["containers.get"]
+    assert [job["targets"] for job in configs] == [["172.17.0.4:9090"]]
+
+    with open(config.options.out) as fin:
+        assert json.load(fin) == configs
+
+
+def test_container_mode_events():
+    config = get_swarm_config(['--mode', 'container'])
+    filters = get_events_filters(config)
+
+    assert filters["label"] == ["prometheus.enable=true"]
+
+
+def test_get_container_name():
+    container = ContainerMock({"Id": "abc", "Names": ["/web"]})
+    assert get_container_name(container) == "web"
+
+    container = ContainerMock({"Id": "abc", "Name": "/web"})
+    assert get_container_name(container) == "web"
+
+
+async def test_static_mode(tmp_path):
+    static_file = tmp_path / "static.json"
+    static_file.write_text(json.dumps({
+        "node": {
+            "prometheus.enable": "true",
+            "prometheus.jobs.node.hosts": "a:9100,b:9100",
+        },
+        "disabled": {
+            "prometheus.jobs.other.hosts": "c:9100",
+        },
+    }))
+
+    config = get_swarm_config([
+        '--mode', 'static', '--static-file', str(static_file)
+    ])
+    assert config.validate()
+    assert not config.backend.listens_events
+
+    configs = await load_existing_services(config)
+
+    assert config.get_client().calls == []
+    assert configs == [{
+        "labels": {"job": "node"},
+        "targets": ["a:9100", "b:9100"],
+    }]
+
+    entry = config.services_entries["node"]
+    await load_existing_services(config)
+    assert config.services_entries["node"] is entry
+
+
+async def test_scrape_configs_interned():
+    config = get_swarm_config([
+        '--meta-labels', '--service-labels', '--container-labels'
+    ])
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    web_id = docker.add_service("web", labels, ["10.0.0.1", "10.0.0.2"])
+
+    await load_existing_services(config)
+
+    jobs = config.services_entries[web_id].jobs
+    assert all(isinstance(job, ScrapeConfig) for job in jobs)
+    assert [job.targets for job in jobs] == [
+        ("10.0.0.1:9090",), ("10.0.0.2:9090",)
+    ]
+    # Replicas share the same labels
+    assert jobs[0].labels is jobs[1].labels
+    assert jobs[0].as_dict()["labels"]["job"] == "main"
+
+    container = config.containers_cache.get("web_container_0")
+    assert isinstance(container, Container)
+    assert container.networks == (("default", "10.0.0.1"),)
+
+    with pytest.raises(AttributeError):
+        jobs[0].job = "other"
+
+
+async def test_snapshot(tmp_path):
+    snapshot = str(tmp_path / "snapshot.json")
+    args = ['--snapshot', snapshot, '--meta-labels', '--container-labels']
+
+    config = get_swarm_config(args)
+    config.options.out = str(tmp_path / "out.json")
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_service("web", labels, ["10.0.0.1", "10.0.0.2"])
+
+    configs = await load_existing_services(config)
+    await save_configs(config, configs)
+    assert os.path.exists(snapshot)
+
+    # Restart with the same docker state
+    restarted = Config(
+        get_parser(),
+        ['--out', str(tmp_path / "restarted.json")] + args,
+        lambda url=None: docker
+    )
+
+    await restore_snapshot(restarted)
+
+    with open(restarted.options.out) as fin:
+        assert json.load(fin) == configs
+    assert not restarted.services_loaded
+
+    docker.calls.clear()
+    assert await load_existing_services(restarted) == configs
+    assert "containers.get" not in docker.calls
+    assert restarted.services_entries["web_id"].key == (
+        config.services_entries["web_id"].key
+    )
+
+
+async def test_snapshot_other_options(tmp_path):
+    snapshot = str(tmp_path / "snapshot.json")
+
+    config = get_swarm_config(['--snapshot', snapshot])
+    config.options.out = str(tmp_path / "out.json")
+    docker = config.get_client()
+
+    labels = {
+        "prometheus.enable": "true",
+        "prometheus.jobs.main.port": "9090",
+    }
+    docker.add_service("web", labels, ["10.0.0.1"])
+
+    configs = await load_existing_services(config)
+    await save_configs(config, configs)
+
+    for args in [
+        ['--mode', 'container'],
+        ['--task-addresses'],
+        ['--meta-labels', '--service-labels'],
+    ]:
+        restarted = Config(
+            get_parser(),
+            ['--out', str(tmp_path / "restarted.json"), '--snapshot', snapshot]
+            + args,
+            lambda url=None: docker
+        )
+
+        await restore_snapshot(restarted)
+
+        assert restarted.services_entries == {}
+        assert not os.path.exists(restarted.options.out)
+
+    # The configs are rebuilt with the meta labels
+    configs = await load_existing_services(restarted)
+    labels = configs[0]["labels"]
+    assert labels["__meta_docker_service_label_prometheus_enable"] == "true"
+
+
+async def test_main_loop_recovered_then_failed(monkeypatch):
+    parser = get_parser()
+    config = Config(
+        parser,
+        [
+            '--backoff-min', '0.01',
+            '--backoff-max', '0.05',
+            '--breaker-threshold', '2',
+        ],
+        DockerMock
+    )
+    config.loop = asyncio.get_event_loop()
+
+    breakers = []
+    failures = []
+    # A healthy iteration followed by a failing one
+    durations = [0.1, 0]
+    stopped = asyncio.Event()
+
+    class RecordingBreaker(CircuitBreaker):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            breakers.append(self)
+
+    async def save_all_configs(config):
+        pass
+
+    async def listen_events(config):
+        failures.append((breakers[0].failures, breakers[0].state))
+        if durations:
+            await asyncio.sleep(durations.pop(0))
+        else:
+            stopped.set()
+            await asyncio.sleep(3600)
+
+    monkeypatch.setattr("prometheus_sd.service.CircuitBreaker", RecordingBreaker)
+    monkeypatch.setattr("prometheus_sd.service.save_all_configs", save_all_configs)
+    monkeypatch.setattr("prometheus_sd.service.listen_events", listen_events)
+
+    task = config.loop.create_task(main_loop(config))
+    try:
+        await asyncio.wait_for(stopped.wait(), 5)
+    finally:
+        task.cancel()
+        for pending in asyncio.all_tasks():
+            if pending is not asyncio.current_task():
+                pending.cancel()
+
+    assert failures == [
+        (0, CircuitBreaker.CLOSED),
+        (0, CircuitBreaker.CLOSED),
+        (1, CircuitBreaker.CLOSED),
+    ]
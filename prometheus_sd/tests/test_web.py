@@ -6,6 +6,7 @@ from prometheus_sd.server import (
     make_server
 )
 from prometheus_sd.config import Config, get_parser
+from prometheus_sd.service import publish_configs, serialize_configs
 from prometheus_sd.tests.test_config import DockerClientMock
 
 async def test_app_metrics(aiohttp_client, loop):
@@ -27,16 +28,25 @@ async def test_app_metrics(aiohttp_client, loop):
     ]
     text = "\n".join(lines)
 
-    assert len(lines) == 80
+    assert len(lines) == 111
 
     assert 'promsd_request_count' in text
     assert 'promsd_build_count' in text
     assert 'promsd_event_count' in text
     assert 'promsd_reinit_count' in text
     assert 'promsd_errors_count' in text
+    assert 'promsd_writes_skipped' in text
+    assert 'promsd_circuit_breaker_state' in text
+    assert 'promsd_resync_count' in text
+    assert 'promsd_resync_drift' in text
     assert 'promsd_build_seconds' in text
     assert 'promsd_config_size_bytes' in text
     assert 'promsd_configs_units' in text
+    assert 'promsd_docker_api_in_flight' in text
+    assert 'promsd_event_latency_seconds' in text
+    assert 'promsd_event_queue_depth' in text
+    assert 'promsd_events_coalesced' in text
+    assert 'promsd_events_dropped' in text
 
 
 async def test_server_metrics(aiohttp_client, loop):
@@ -57,3 +67,32 @@ async def test_server_metrics(aiohttp_client, loop):
     async with aiohttp.ClientSession() as session:
         async with session.get('http://localhost:9090/metrics') as resp:
             assert resp.status == 200
+
+
+async def test_app_http_sd(aiohttp_client):
+    parser = get_parser()
+    config = Config(parser, args=['--http-sd'])
+    app = make_app(config)
+
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/http_sd')
+    assert resp.status == 503
+
+    data, digest = serialize_configs([
+        {"labels": {"job": "web"}, "targets": ["10.0.0.1:80"]}
+    ])
+    publish_configs(config, data, digest)
+
+    resp = await client.get('/http_sd')
+    assert resp.status == 200
+    assert resp.headers['ETag'] == '"%s"' % (digest,)
+
+    configs = await resp.json()
+    assert configs[0]["targets"] == ["10.0.0.1:80"]
+
+    resp = await client.get(
+        '/http_sd', headers={'If-None-Match': resp.headers['ETag']}
+    )
+    assert resp.status == 304
+    assert await resp.read() == b''
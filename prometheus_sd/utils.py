@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 import re
+import functools
+
+from .cache import LRUCache
 
 # Label names to look for
 label_template = "prometheus.labels."
@@ -12,6 +15,11 @@ LABEL_TEMPLATE = '%s_%s_label_%s'
 # Sanitize constants
 invalid_label_name_chars = "[^a-zA-Z0-9_]"
 invalid_label_name_re = re.compile(invalid_label_name_chars)
+invalid_filename_chars = "[^a-zA-Z0-9_.-]"
+invalid_filename_re = re.compile(invalid_filename_chars)
+
+# Parsed prometheus configs indexed by their labels
+prometheus_config_cache = LRUCache(1024)
 
 def extract_prometheus_labels(labels):
     prometheus_labels = {
@@ -23,20 +31,18 @@ def extract_prometheus_labels(labels):
 
 
 def dotted_setter(obj, key):
-    parts = key.split('.')
+    *parents, name = key.split('.')
 
-    if parts[0] not in obj:
-        obj[parts[0]] = {}
+    for part in parents:
+        obj = obj.setdefault(part, {})
 
-    if len(parts) > 2:
-        return dotted_setter(obj[parts[0]], ".".join(parts[1:]))
-    else:
-        def setter(value):
-            obj[parts[0]][parts[1]] = value
-        return setter
+    def setter(value):
+        obj[name] = value
+    return setter
 
 
 def convert_labels_to_config(prometheus_labels):
+    """Convert dotted labels to nested dicts in a single pass"""
     config = {}
 
     for label, value in prometheus_labels.items():
@@ -45,11 +51,37 @@ def convert_labels_to_config(prometheus_labels):
     return config
 
 
+def parse_prometheus_config(labels):
+    """
+    Returns the config defined by the prometheus labels of `labels`.
+
+    Parsed configs are cached by prometheus labels so objects with the same
+    labels are only parsed once. The returned config is shared and must
+    not be modified.
+    """
+    prometheus_labels = extract_prometheus_labels(labels)
+    key = frozenset(prometheus_labels.items())
+
+    config = prometheus_config_cache.get(key)
+
+    if config is None:
+        config = convert_labels_to_config(prometheus_labels)
+        prometheus_config_cache.set(key, config)
+
+    return config
+
+
 def sanitize_label(label):
     """Sanitize labels according to the recommendations"""
     return re.sub(invalid_label_name_re, "_", label)
 
 
+def sanitize_filename(name):
+    """Sanitize names to be used as file names"""
+    return re.sub(invalid_filename_re, "_", name)
+
+
+@functools.lru_cache(maxsize=8192)
 def format_label(label_type, key):
     return sanitize_label(
         LABEL_TEMPLATE % (
@@ -21,6 +21,9 @@ setuptools.setup(
     url="https://github.com/llacroix/prometheus-sd",
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    extras_require={
+        "orjson": ["orjson"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",